@@ -0,0 +1,19 @@
+"""
+The t4 modules are imported on first access, so `import t4` is cheap and
+t4.typography, t4.web etc. work without importing each one explicitly.
+"""
+import importlib
+
+_submodules = { "cidr", "mailmetrics", "mailspool", "passwords",
+                "rendercache", "res", "sendmail", "sql", "title_to_id",
+                "typography", "web", }
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("t4." + name)
+    else:
+        raise AttributeError("module %r has no attribute %r" % ( __name__,
+                                                                 name, ))
+
+def __dir__():
+    return sorted(set(globals()) | _submodules)
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+Run title_to_id(), safe_filename() or improve_typography() over a whole
+corpus on all cores:
+
+  python -m t4 slug titles.jsonl > ids.jsonl
+  python -m t4 filename --field name uploads.csv -o safe.csv
+  python -m t4 typography --lang en --html articles/ -o articles.new/
+
+Input is a JSONL file (one object per line), a CSV file with a header
+line or a directory of UTF-8 text files, each of which is one record.
+For JSONL and CSV the result is added to each record as --output-field;
+for a directory, the result for each file is written to the same relative
+path below the --output directory. Records are processed in batches of
+--batch-size by a pool of --jobs worker processes. Progress and
+throughput go to stderr.
+"""
+
+import sys, os, os.path as op, argparse, json, csv, time, collections
+import contextlib, concurrent.futures
+
+from t4 import title_to_id, typography
+
+default_fields = { "slug": "title",
+                   "filename": "name",
+                   "typography": "text", }
+
+def make_function(command, options):
+    """
+    Return the function `command` applies to each value, with the
+    `options` from the command line.
+    """
+    if command == "slug":
+        return lambda value: title_to_id.title_to_id(
+            value, all_lowercase=not options["keep_case"],
+            separator=options["separator"])
+    elif command == "filename":
+        return lambda value: title_to_id.safe_filename(
+            value, contains_dir=options["contains_dir"],
+            unicode_normalize_to=options["normalize"])
+    elif command == "typography":
+        if options["html"]:
+            improve = typography.improve_typography_html
+        else:
+            improve = typography.improve_typography
+        return lambda value: improve(value, options["lang"])
+    else:
+        raise ValueError(command)
+
+# The function in worker processes, set by _init_worker().
+_function = None
+
+def _init_worker(command, options):
+    global _function
+    _function = make_function(command, options)
+
+def _run_batch(values):
+    return [ _function(value) for value in values ]
+
+def _run_file_batch(paths):
+    """
+    Transform each ( source, destination, ) file and return the number of
+    characters read.
+    """
+    ret = 0
+    for source, destination in paths:
+        with open(source, encoding="utf-8") as fp:
+            text = fp.read()
+        os.makedirs(op.dirname(destination), exist_ok=True)
+        with open(destination, "w", encoding="utf-8") as fp:
+            fp.write(_function(text))
+        ret += len(text)
+    return ret
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def run_batches(function, batches, jobs, ordered, initargs,
+                argument=lambda batch: batch):
+    """
+    Yield ( batch, result, ) for each of the `batches`, with `result` the
+    return value of function(argument(batch)) in a worker process. At
+    most twice as many batches as there are `jobs` are in flight at any
+    time. With a single job, everything runs in this process.
+    """
+    if jobs == 1:
+        _init_worker(*initargs)
+        for batch in batches:
+            yield batch, function(argument(batch))
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=_init_worker, initargs=initargs) as pool:
+        pending = collections.OrderedDict()
+        batches = iter(batches)
+        exhausted = False
+
+        while True:
+            while not exhausted and len(pending) < jobs * 2:
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                else:
+                    pending[pool.submit(function, argument(batch))] = batch
+
+            if not pending:
+                break
+
+            if ordered:
+                done = [ next(iter(pending)), ]
+            else:
+                done, not_done = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                batch = pending.pop(future)
+                yield batch, future.result()
+
+class progress:
+    """
+    Report the number of records done and the throughput on stderr, at
+    most once per `interval` seconds.
+    """
+    def __init__(self, quiet=False, interval=1.0):
+        self.quiet = quiet
+        self.interval = interval
+        self.records = 0
+        self.characters = 0
+        self.start = self.last = time.monotonic()
+
+    def __call__(self, records, characters):
+        self.records += records
+        self.characters += characters
+
+        now = time.monotonic()
+        if not self.quiet and now - self.last >= self.interval:
+            self.last = now
+            sys.stderr.write("\r" + self.report(now))
+            sys.stderr.flush()
+
+    def report(self, now):
+        elapsed = max(now - self.start, 1e-9)
+        return "%i records, %.0f records/s, %.2f MB/s" % (
+            self.records, self.records / elapsed,
+            self.characters / elapsed / 1e6, )
+
+    def finish(self):
+        if not self.quiet:
+            now = time.monotonic()
+            sys.stderr.write("\r%s in %.1fs\n" % ( self.report(now),
+                                                    now - self.start, ))
+
+class skip_report:
+    """
+    Report records that can’t be processed on stderr, the first
+    `max_reported` by line number, and how many there were in the end.
+    Such records are written unchanged rather than stopping the run.
+    """
+    def __init__(self, field, max_reported=10):
+        self.field = field
+        self.max_reported = max_reported
+        self.count = 0
+
+    def __call__(self, line_number, reason=None):
+        if reason is None:
+            reason = "No text in %s" % repr(self.field)
+
+        self.count += 1
+        if self.count <= self.max_reported:
+            sys.stderr.write("\rLine %i: %s, passed through unchanged.\n" % (
+                line_number, reason, ))
+
+    def finish(self):
+        if self.count > self.max_reported:
+            sys.stderr.write("%i records passed through unchanged.\n" % (
+                self.count, ))
+
+class malformed_line:
+    """
+    A JSONL line that is not valid JSON, to be written as it is.
+    """
+    def __init__(self, line, error):
+        self.line = line
+        self.error = error
+
+def parse_json_line(line):
+    try:
+        return json.loads(line)
+    except ValueError as exc:
+        return malformed_line(line, exc)
+
+def detect_format(path):
+    if op.isdir(path):
+        return "dir"
+    elif path.lower().endswith(".csv"):
+        return "csv"
+    else:
+        return "jsonl"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m t4",
+        description="Run t4 text functions over JSONL, CSV or a directory "
+                    "of text files, on all cores.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name, help):
+        command = commands.add_parser(name, help=help)
+        command.add_argument("input", nargs="?", default="-",
+                             help="JSONL or CSV file or a directory, "
+                                  "- (the default) for stdin")
+        command.add_argument("-o", "--output", default="-",
+                             help="Output file, - (the default) for "
+                                  "stdout, or a directory")
+        command.add_argument("--format", choices=( "jsonl", "csv", "dir", ),
+                             help="Input format, by default guessed from "
+                                  "the input’s name")
+        command.add_argument("--field", default=default_fields[name],
+                             help="JSONL key or CSV column to read "
+                                  "(default: %(default)s)")
+        command.add_argument("--output-field", default="result",
+                             help="JSONL key or CSV column to write "
+                                  "(default: %(default)s)")
+        command.add_argument("-j", "--jobs", type=int,
+                             default=os.cpu_count() or 1,
+                             help="Worker processes (default: %(default)s)")
+        command.add_argument("--batch-size", type=int, default=256,
+                             help="Records per batch (default: "
+                                  "%(default)s)")
+        command.add_argument("--unordered", action="store_true",
+                             help="Write results as batches finish rather "
+                                  "than in input order")
+        command.add_argument("-q", "--quiet", action="store_true",
+                             help="Don’t report progress")
+        return command
+
+    slug = add_command("slug", "title_to_id()")
+    slug.add_argument("--keep-case", action="store_true")
+    slug.add_argument("--separator", default="_")
+
+    filename = add_command("filename", "safe_filename()")
+    filename.add_argument("--contains-dir", action="store_true")
+    filename.add_argument("--normalize", default="NFD",
+                          choices=( "NFC", "NFD", "NFKC", "NFKD", ))
+
+    typography_command = add_command("typography", "improve_typography()")
+    typography_command.add_argument("--lang", default="de")
+    typography_command.add_argument("--html", action="store_true",
+                                    help="Input is HTML, see "
+                                         "improve_typography_html()")
+
+    args = parser.parse_args(argv)
+
+    options = { name: value for name, value in vars(args).items()
+                if name in ( "keep_case", "separator", "contains_dir",
+                             "normalize", "lang", "html", ) }
+    initargs = ( args.command, options, )
+
+    format = args.format or detect_format(args.input)
+    if format == "dir":
+        return process_directory(args, initargs)
+    else:
+        return process_file(args, initargs, format)
+
+def process_directory(args, initargs):
+    if args.output == "-":
+        sys.exit("A directory needs an --output directory.")
+
+    def paths():
+        for dirpath, dirnames, filenames in os.walk(args.input):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                source = op.join(dirpath, filename)
+                yield ( source, op.join(args.output,
+                                        op.relpath(source, args.input)), )
+
+    report = progress(args.quiet)
+    for batch, characters in run_batches(
+            _run_file_batch, batches(paths(), args.batch_size),
+            args.jobs, not args.unordered, initargs):
+        report(len(batch), characters)
+    report.finish()
+
+def process_file(args, initargs, format):
+    with contextlib.ExitStack() as files:
+        if args.input == "-":
+            infile = sys.stdin
+        else:
+            infile = files.enter_context(open(args.input, encoding="utf-8",
+                                              newline=""))
+
+        if args.output == "-":
+            outfile = sys.stdout
+        else:
+            outfile = files.enter_context(open(args.output, "w",
+                                               encoding="utf-8", newline=""))
+
+        if format == "csv":
+            reader = csv.DictReader(infile)
+            fieldnames = list(reader.fieldnames or [])
+            if args.output_field not in fieldnames:
+                fieldnames.append(args.output_field)
+            writer = csv.DictWriter(outfile, fieldnames)
+            writer.writeheader()
+            # ( line number, record, ) pairs.
+            records = ( ( reader.line_num, record, ) for record in reader )
+            write = writer.writerow
+        else:
+            records = ( ( number, parse_json_line(line), )
+                        for number, line in enumerate(infile, 1)
+                        if line.strip() )
+
+            def write(record):
+                if isinstance(record, malformed_line):
+                    outfile.write(record.line.rstrip("\r\n") + "\n")
+                else:
+                    outfile.write(json.dumps(record, ensure_ascii=False)
+                                  + "\n")
+
+        def value(record):
+            """
+            Return the str to process in `record`, or None if there is
+            none.
+            """
+            if isinstance(record, dict):
+                ret = record.get(args.field)
+                if isinstance(ret, str):
+                    return ret
+            return None
+
+        # The workers only get the values, not whole records.
+        def values(batch):
+            return [ v for v in ( value(record) for number, record in batch )
+                     if v is not None ]
+
+        report = progress(args.quiet)
+        skipped = skip_report(args.field)
+        for batch, results in run_batches(
+                _run_batch, batches(records, args.batch_size),
+                args.jobs, not args.unordered, initargs, values):
+            results = iter(results)
+            characters = 0
+            for number, record in batch:
+                v = value(record)
+                if isinstance(record, malformed_line):
+                    skipped(number, "Not valid JSON (%s)" % record.error)
+                elif v is None:
+                    skipped(number)
+                else:
+                    record[args.output_field] = next(results)
+                    characters += len(v)
+                write(record)
+            report(len(batch), characters)
+        report.finish()
+        skipped.finish()
+
+if __name__ == "__main__":
+    try:
+        main()
+    except BrokenPipeError:
+        # Output piped into head or the like. Keep Python from
+        # complaining about it again when it flushes stdout on exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2025 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+Sets of IPv4 networks for access control and block lists.
+
+A cidr_set keeps its networks as two sorted arrays of 32 bit integers,
+the first and last address of each range, with overlapping and adjacent
+networks merged. Lookups are binary searches. save() writes the arrays as
+they are, so load() is little more than a read().
+"""
+
+import sys, array, bisect, struct
+
+from t4.res import ip_v4_address_with_mask_re_groups
+
+def address_to_int(address):
+    """
+    Convert a dotted quad to an integer.
+    """
+    first, last = parse_network(address)
+    if first != last:
+        raise ValueError("Not a single address: %s" % repr(address))
+    return first
+
+def int_to_address(i):
+    return "%i.%i.%i.%i" % ( i >> 24, (i >> 16) & 255, (i >> 8) & 255, i & 255, )
+
+def parse_network(network):
+    """
+    Return the first and last address of an IPv4 network like
+    “192.168.1.0/24” (or a single address) as integers.
+    """
+    match = ip_v4_address_with_mask_re_groups.fullmatch(network.strip())
+    if match is None:
+        raise ValueError("Not an IPv4 network: %s" % repr(network))
+
+    a, b, c, d, mask = match.groups()
+    address = 0
+    for octet in ( a, b, c, d, ):
+        octet = int(octet)
+        if octet > 255:
+            raise ValueError("Not an IPv4 network: %s" % repr(network))
+        address = (address << 8) | octet
+
+    if mask is None:
+        bits = 32
+    else:
+        bits = int(mask[1:])
+        if bits > 32:
+            raise ValueError("Not an IPv4 network: %s" % repr(network))
+
+    hostmask = (1 << (32 - bits)) - 1
+    first = address & ~hostmask & 0xffffffff
+    return ( first, first | hostmask, )
+
+def _uint32_array(values=()):
+    for typecode in "IL":
+        if array.array(typecode).itemsize == 4:
+            return array.array(typecode, values)
+    raise TypeError("No 32 bit array type on this platform.")
+
+class cidr_set:
+    """
+    A set of IPv4 networks. `networks` is an iterable of network strings
+    (see parse_network()) or ( first, last, ) integer tuples.
+    """
+    magic = b"t4cidr1\n"
+
+    def __init__(self, networks=()):
+        ranges = []
+        for network in networks:
+            if isinstance(network, str):
+                network = parse_network(network)
+            ranges.append(network)
+        ranges.sort()
+
+        self.starts = _uint32_array()
+        self.ends = _uint32_array()
+
+        for first, last in ranges:
+            if self.ends and first <= self.ends[-1] + 1:
+                if last > self.ends[-1]:
+                    self.ends[-1] = last
+            else:
+                self.starts.append(first)
+                self.ends.append(last)
+
+    def __len__(self):
+        """
+        The number of (merged) address ranges.
+        """
+        return len(self.starts)
+
+    def ranges(self):
+        return zip(self.starts, self.ends)
+
+    def __contains__(self, address):
+        if isinstance(address, str):
+            address = address_to_int(address)
+
+        idx = bisect.bisect_right(self.starts, address) - 1
+        return idx >= 0 and address <= self.ends[idx]
+
+    def contains_many(self, addresses):
+        """
+        Look up many addresses at once. `addresses` is an iterable of
+        dotted quads or integers, or a NumPy integer array, in which case
+        a boolean array is returned. Otherwise the result is a list of
+        bools.
+        """
+        if type(addresses).__module__ == "numpy":
+            import numpy
+            starts = numpy.frombuffer(self.starts, dtype=numpy.uint32)
+            ends = numpy.frombuffer(self.ends, dtype=numpy.uint32)
+            idx = numpy.searchsorted(starts, addresses, side="right") - 1
+            found = idx >= 0
+            ret = numpy.zeros(len(addresses), dtype=bool)
+            ret[found] = addresses[found] <= ends[idx[found]]
+            return ret
+
+        addresses = [ address_to_int(a) if isinstance(a, str) else a
+                      for a in addresses ]
+
+        # Walk the sorted addresses and the ranges side by side.
+        order = sorted(range(len(addresses)), key=addresses.__getitem__)
+        starts, ends = self.starts, self.ends
+        count = len(starts)
+        ret = [ False, ] * len(addresses)
+        idx = 0
+        for a in order:
+            address = addresses[a]
+            while idx < count and ends[idx] < address:
+                idx += 1
+            if idx == count:
+                break
+            ret[a] = starts[idx] <= address
+
+        return ret
+
+    def save(self, fp):
+        """
+        Write the set to a binary file (or path).
+        """
+        if isinstance(fp, str):
+            with open(fp, "wb") as f:
+                return self.save(f)
+
+        starts, ends = self.starts, self.ends
+        if sys.byteorder == "big":
+            starts, ends = _uint32_array(starts), _uint32_array(ends)
+            starts.byteswap()
+            ends.byteswap()
+
+        fp.write(self.magic)
+        fp.write(struct.pack("<I", len(starts)))
+        fp.write(starts.tobytes())
+        fp.write(ends.tobytes())
+
+    @classmethod
+    def load(cls, fp):
+        """
+        Read a set written by save() from a binary file (or path).
+        """
+        if isinstance(fp, str):
+            with open(fp, "rb") as f:
+                return cls.load(f)
+
+        if fp.read(len(cls.magic)) != cls.magic:
+            raise ValueError("Not a cidr_set file.")
+        count, = struct.unpack("<I", fp.read(4))
+
+        self = cls()
+        self.starts.frombytes(fp.read(count * 4))
+        self.ends.frombytes(fp.read(count * 4))
+        if len(self.ends) != count:
+            raise ValueError("Truncated cidr_set file.")
+
+        if sys.byteorder == "big":
+            self.starts.byteswap()
+            self.ends.byteswap()
+
+        return self
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+Mail observers for t4.sendmail.set_mail_observer() that export what
+they see to a local metrics sink:
+
+  from t4.sendmail import set_mail_observer
+  from t4.mailmetrics import statsd_exporter, prometheus_textfile_exporter
+
+  set_mail_observer(statsd_exporter(( "127.0.0.1", 8125, )))
+  set_mail_observer(prometheus_textfile_exporter(
+      "/var/lib/node_exporter/textfile/t4_sendmail.prom"))
+
+Both count messages, failures, recipients and bytes, and report the time
+spent in each stage, by transport. Neither lets a failing sink get in the
+way of sending mail.
+"""
+
+import os, threading, time, socket, atexit
+
+stages = ( "compose", "encode", "deliver", )
+
+class statsd_exporter:
+    """
+    Send one UDP datagram of StatsD lines per message to `address`,
+    with metric names like t4.sendmail.smtp_transport.deliver.
+    """
+    def __init__(self, address=( "127.0.0.1", 8125, ),
+                 prefix="t4.sendmail"):
+        self.address = address
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def lines(self, event):
+        prefix = "%s.%s." % ( self.prefix, event.transport or "none", )
+
+        ret = [ prefix + "messages:1|c",
+                prefix + "recipients:%i|c" % event.recipients,
+                prefix + "bytes:%i|c" % event.size, ]
+        if event.error is not None:
+            ret.append(prefix + "failures:1|c")
+
+        for stage in stages:
+            if stage in event.timings:
+                ret.append(prefix + "%s:%.3f|ms" % (
+                    stage, event.timings[stage] * 1000, ))
+
+        return ret
+
+    def __call__(self, event):
+        try:
+            self._socket.sendto("\n".join(self.lines(event)).encode("ascii"),
+                                self.address)
+        except OSError:
+            pass
+
+    def close(self):
+        self._socket.close()
+
+class prometheus_textfile_exporter:
+    """
+    Keep counters and per-stage latency histograms and write them to
+    `path` in the Prometheus text format, for node_exporter’s textfile
+    collector to pick up. The file is replaced atomically, at most every
+    `interval` seconds and when the process exits.
+    """
+    buckets = ( 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, )
+
+    def __init__(self, path, interval=10):
+        self.path = path
+        self.interval = interval
+
+        # Map ( function, transport, ) to [ messages, failures,
+        # recipients, bytes, ].
+        self._counters = {}
+
+        # Map ( stage, transport, ) to [ count per bucket…, count, sum, ].
+        self._histograms = {}
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._last_write = 0.0
+        atexit.register(self.flush)
+
+    def __call__(self, event):
+        transport = event.transport or "none"
+
+        with self._lock:
+            counters = self._counters.setdefault(
+                ( event.function, transport, ), [ 0, 0, 0, 0, ])
+            counters[0] += 1
+            if event.error is not None:
+                counters[1] += 1
+            counters[2] += event.recipients
+            counters[3] += event.size
+
+            for stage, seconds in event.timings.items():
+                histogram = self._histograms.get( (stage, transport,) )
+                if histogram is None:
+                    histogram = [ 0 ] * (len(self.buckets) + 2)
+                    self._histograms[ (stage, transport,) ] = histogram
+
+                for a, bound in enumerate(self.buckets):
+                    if seconds <= bound:
+                        histogram[a] += 1
+                histogram[-2] += 1
+                histogram[-1] += seconds
+
+            write = time.monotonic() - self._last_write >= self.interval
+
+        if write:
+            self.flush()
+
+    def text(self):
+        """
+        Return the metrics in the Prometheus text format.
+        """
+        with self._lock:
+            counters = sorted( (key, list(values),)
+                               for key, values in self._counters.items() )
+            histograms = sorted( (key, list(values),)
+                                 for key, values in self._histograms.items() )
+
+        ret = []
+        for index, name, help in (
+                ( 0, "messages", "Messages handed to a transport.", ),
+                ( 1, "failures", "Messages whose delivery failed.", ),
+                ( 2, "recipients", "Envelope recipients.", ),
+                ( 3, "bytes", "Size of the messages delivered.", ), ):
+            name = "t4_sendmail_%s_total" % name
+            ret.append("# HELP %s %s" % ( name, help, ))
+            ret.append("# TYPE %s counter" % name)
+            for ( function, transport, ), values in counters:
+                ret.append('%s{function="%s",transport="%s"} %i' % (
+                    name, function, transport, values[index], ))
+
+        name = "t4_sendmail_stage_seconds"
+        ret.append("# HELP %s Time spent composing, encoding and "
+                   "delivering messages." % name)
+        ret.append("# TYPE %s histogram" % name)
+        for ( stage, transport, ), values in histograms:
+            labels = 'stage="%s",transport="%s"' % ( stage, transport, )
+            for bound, count in zip(self.buckets, values):
+                ret.append('%s_bucket{%s,le="%s"} %i' % (
+                    name, labels, bound, count, ))
+            ret.append('%s_bucket{%s,le="+Inf"} %i' % (
+                name, labels, values[-2], ))
+            ret.append("%s_sum{%s} %r" % ( name, labels, values[-1], ))
+            ret.append("%s_count{%s} %i" % ( name, labels, values[-2], ))
+
+        return "\n".join(ret) + "\n"
+
+    def flush(self):
+        """
+        Write the metrics to `path` now.
+        """
+        with self._lock:
+            self._last_write = time.monotonic()
+
+        tmppath = "%s.%i.tmp" % ( self.path, os.getpid(), )
+        with self._write_lock:
+            try:
+                with open(tmppath, "w", encoding="ascii") as fp:
+                    fp.write(self.text())
+                os.replace(tmppath, self.path)
+            except OSError:
+                pass
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+A spool directory for outgoing mail, so web requests don’t have to wait
+for delivery. mail_spool.enqueue() takes the same arguments as
+t4.sendmail.sendmail(), composes the message and writes it to the spool.
+The worker threads started by mail_spool.start() deliver it.
+
+The spool directory has four sub-directories, much like a Maildir:
+
+tmp   Messages being written.
+new   Messages waiting for delivery.
+cur   Messages a worker is delivering right now.
+dead  Messages that failed permanently or too often, each with a
+      .error file next to it.
+
+Each spool file starts with a line of JSON holding the envelope and the
+number of delivery attempts so far, followed by the composed message.
+File names start with the time (in milliseconds) before which the message
+is not to be delivered, so they sort in delivery order.
+
+Only one process may run workers on a spool directory, because start()
+returns everything in cur to new: A message is in cur only if a worker
+crashed while delivering it.
+"""
+
+import os, os.path as op, time, json, uuid, threading, traceback, logging
+
+from t4 import sendmail as _sendmail
+
+logger = logging.getLogger(__name__)
+
+class mail_spool:
+    def __init__(self, directory, transport=None, workers=4,
+                 max_attempts=8, backoff=60, max_backoff=3600,
+                 poll_interval=1.0):
+        """
+        `transport` defaults to t4.sendmail.get_transport(). A message
+        that fails is retried after `backoff` seconds, doubling with each
+        attempt up to `max_backoff`, and moved to dead after
+        `max_attempts`.
+        """
+        self.directory = directory
+        self.transport = transport
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+
+        for name in ( "tmp", "new", "cur", "dead", ):
+            os.makedirs(op.join(directory, name), exist_ok=True)
+
+        self._threads = []
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+
+    def path(self, subdir, filename):
+        return op.join(self.directory, subdir, filename)
+
+    def enqueue(self, from_name, from_email,
+                to_name, to_email,
+                subject, message, attachments=[], headers={}, bcc=[],
+                text_subtype="plain", encoding="utf-8",
+                multipart_subtype="mixed"):
+        """
+        Compose a message like t4.sendmail.sendmail() does and put it in
+        the spool. Return its file name.
+        """
+        composed = _sendmail.compose(from_name, from_email, to_name, to_email,
+                                     subject, message, attachments, headers,
+                                     bcc, text_subtype, encoding,
+                                     multipart_subtype)
+        return self.enqueue_composed(from_email, [ to_email, ] + list(bcc),
+                                     composed)
+
+    def enqueue_composed(self, envelope_from, recipients, composed):
+        """
+        Put an already composed message into the spool. `composed` is a
+        str or an iterable of str pieces, like a composed_message.
+        """
+        envelope = { "from": envelope_from,
+                     "recipients": list(recipients),
+                     "attempts": 0, }
+        return self._write(envelope, composed, time.time())
+
+    def _write(self, envelope, composed, not_before, subdir="new",
+               filename=None):
+        if filename is None:
+            filename = "%013i-%s" % ( not_before * 1000, uuid.uuid4().hex, )
+        tmppath = self.path("tmp", filename)
+
+        if isinstance(composed, str):
+            composed = [ composed, ]
+
+        try:
+            with open(tmppath, "w", encoding="utf-8", newline="") as fp:
+                fp.write(json.dumps(envelope))
+                fp.write("\n")
+                for chunk in composed:
+                    fp.write(chunk)
+                fp.flush()
+                os.fsync(fp.fileno())
+        except:
+            os.unlink(tmppath)
+            raise
+
+        os.rename(tmppath, self.path(subdir, filename))
+        self._wakeup.set()
+
+        return filename
+
+    def recover(self):
+        """
+        Return messages left in cur by a crashed worker to new.
+        """
+        for filename in os.listdir(self.path("cur", "")):
+            os.rename(self.path("cur", filename),
+                      self.path("new", filename))
+
+    def _claim(self):
+        """
+        Move the next message that is due from new to cur and return its
+        file name, or None if there is none.
+        """
+        now = "%013i" % ( time.time() * 1000, )
+
+        with self._pending_lock:
+            if not self._pending:
+                self._pending = sorted(os.listdir(self.path("new", "")),
+                                       reverse=True)
+
+            while self._pending:
+                filename = self._pending[-1]
+                if filename[:13] > now:
+                    # Nothing else is due either. Re-read the directory
+                    # next time, new messages may have arrived.
+                    self._pending = []
+                    return None
+
+                self._pending.pop()
+                try:
+                    os.rename(self.path("new", filename),
+                              self.path("cur", filename))
+                except FileNotFoundError:
+                    continue
+                else:
+                    return filename
+
+        return None
+
+    def process_one(self):
+        """
+        Deliver the next due message, if any. Return whether there was
+        one. A message that can’t be handled at all, e.g. because its
+        envelope is corrupt, goes to dead.
+        """
+        filename = self._claim()
+        if filename is None:
+            return False
+
+        try:
+            self._deliver(filename)
+        except Exception as exc:
+            logger.exception("Can’t handle spooled message %s", filename)
+            self._bury(filename, exc)
+
+        return True
+
+    def _deliver(self, filename):
+        path = self.path("cur", filename)
+        with open(path, encoding="utf-8", newline="") as fp:
+            envelope = json.loads(fp.readline())
+        composed = spooled_message(path)
+
+        transport = self.transport or _sendmail.get_transport()
+        try:
+            with _sendmail._observation(
+                    "mail_spool", len(envelope["recipients"])) as event:
+                if event is None:
+                    delivered = composed
+                else:
+                    delivered = event.delivering(composed, transport)
+
+                transport.deliver(envelope["from"], envelope["recipients"],
+                                  delivered)
+        except Exception as exc:
+            self._failed(filename, envelope, composed, exc)
+        else:
+            os.unlink(path)
+
+    def _failed(self, filename, envelope, composed, exc):
+        """
+        Re-spool a message that failed for the recipients it may still
+        reach and bury it for the others.
+        """
+        import smtplib
+
+        envelope["attempts"] += 1
+
+        recipients = envelope["recipients"]
+        if isinstance(exc, smtplib.SMTPRecipientsRefused) and not any(
+                code == 421 for code, msg in exc.recipients.values()):
+            # The message has been delivered to everyone else. (A 421
+            # means the server hung up before DATA, but our transports
+            # raise SMTPServerDisconnected for that.)
+            recipients = [ recipient for recipient in recipients
+                           if recipient in exc.recipients ]
+            later = [ recipient for recipient in recipients
+                      if exc.recipients[recipient][0] < 500 ]
+        elif permanent(exc):
+            later = []
+        else:
+            later = recipients
+
+        if envelope["attempts"] >= self.max_attempts:
+            later = []
+
+        if later:
+            delay = min(self.backoff * 2 ** (envelope["attempts"]-1),
+                        self.max_backoff)
+            self._write(dict(envelope, recipients=later), composed,
+                        time.time() + delay)
+
+        dead = [ recipient for recipient in recipients
+                 if recipient not in later ]
+        if not dead:
+            os.unlink(self.path("cur", filename))
+        elif dead == envelope["recipients"]:
+            self._bury(filename, exc)
+        else:
+            self._bury(filename, exc, dict(envelope, recipients=dead),
+                       composed)
+
+    def _bury(self, filename, exc, envelope=None, composed=None):
+        """
+        Move a message to dead with an .error file next to it. If an
+        `envelope` is given, the message is written with it instead.
+        """
+        with open(self.path("dead", filename + ".error"), "w",
+                  encoding="utf-8") as fp:
+            fp.write("".join(traceback.format_exception(exc)))
+
+        if envelope is None:
+            os.rename(self.path("cur", filename),
+                      self.path("dead", filename))
+        else:
+            self._write(envelope, composed, None, "dead", filename)
+            os.unlink(self.path("cur", filename))
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                busy = self.process_one()
+            except Exception:
+                # Most likely the spool directory itself is in trouble.
+                # Keep trying, just not in a tight loop.
+                logger.exception("mail_spool worker")
+                busy = False
+
+            if not busy:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def start(self):
+        """
+        Recover messages from a previous run and start the worker
+        threads.
+        """
+        self.recover()
+        self._stop.clear()
+        for a in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name="mail_spool worker %i" % a)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, wait=True):
+        """
+        Stop the workers after the messages they are delivering right now.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+class spooled_message:
+    """
+    The message in a spool file, read in pieces as it is iterated over.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, encoding="utf-8", newline="") as fp:
+            fp.readline() # Skip the envelope.
+            while True:
+                chunk = fp.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+def permanent(exc):
+    """
+    Is `exc` a delivery failure re-trying won’t fix?
+    """
+    import smtplib
+
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, msg in exc.recipients.values())
+    elif isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code >= 500
+    else:
+        return False
@@ -25,64 +25,491 @@
 ##
 ##  I have added a copy of the GPL in the file COPYING
 
-import sys, os, os.path as op, types, subprocess, threading, random, itertools
+import sys, os, os.path as op, types, threading
+import secrets, struct, mmap, math, hashlib, hmac, base64, time
 from string import *
 from types import *
 
-def apple_style_random_password(groupnum=4, grouplength=3):
-    letters = "ABCDEFGHJKLMNPQRSTUVWYXZabcdefghijkmnpqrstuvwyxz"
-    digits = "0123456789"
-    characters = letters + digits
+class _random_characters:
+    """
+    Draw characters uniformly from `alphabet`, reading os.urandom() in
+    large blocks. Each random byte is mapped to alphabet[byte % len], and
+    bytes above the largest multiple of len(alphabet) are discarded, so
+    there is no modulo bias. Both steps are a single bytes.translate().
+    """
+    def __init__(self, alphabet, blocksize=8192):
+        count = len(alphabet)
+        if not 0 < count <= 256:
+            raise ValueError("Alphabets must have 1 to 256 characters.")
 
-    def groups():
-        while True:
-            yield "".join(random.sample(characters, grouplength))
+        limit = 256 - 256 % count
+        self.table = bytes(ord(alphabet[byte % count]) for byte in range(256))
+        self.delete = bytes(range(limit, 256))
+        self.blocksize = blocksize
+        self.buffer = ""
 
-    groups = itertools.islice(groups(), groupnum)
-    ret = "-".join(groups)
+    def take(self, count):
+        """
+        Return a string of `count` random characters.
+        """
+        while len(self.buffer) < count:
+            block = os.urandom(max(self.blocksize, count - len(self.buffer)))
+            self.buffer += block.translate(self.table,
+                                           self.delete).decode("ascii")
 
-    for d in digits:
-        if d in ret:
-            return ret
+        ret, self.buffer = self.buffer[:count], self.buffer[count:]
+        return ret
+
+# One generator per alphabet and thread, so the buffers need no locking.
+_random_state = threading.local()
+
+def _reset_random_state():
+    # A forked child must not hand out the random characters its parent
+    # buffered (and may hand out, too).
+    global _random_state
+    _random_state = threading.local()
+
+os.register_at_fork(after_in_child=_reset_random_state)
+
+def _characters(alphabet):
+    generators = getattr(_random_state, "generators", None)
+    if generators is None:
+        generators = _random_state.generators = {}
+
+    generator = generators.get(alphabet)
+    if generator is None:
+        generator = generators[alphabet] = _random_characters(alphabet)
+    return generator
+
+def _batch(n, make, unique, possible):
+    """
+    Return `n` results of make(count), which returns a list of `count`
+    results, optionally unique within the batch. `possible` is the number
+    of different results make() can return.
+    """
+    if not unique:
+        return make(n)
+
+    if n > possible:
+        raise ValueError("Only %i different results possible." % possible)
+
+    ret = []
+    seen = set()
+    while len(ret) < n:
+        for item in make(n - len(ret)):
+            if item not in seen:
+                seen.add(item)
+                ret.append(item)
+    return ret
+
+password_letters = "ABCDEFGHJKLMNPQRSTUVWYXZabcdefghijkmnpqrstuvwyxz"
+password_digits = "0123456789"
+
+def apple_style_random_passwords(n, groupnum=4, grouplength=3, unique=False):
+    """
+    Return a list of `n` passwords like apple_style_random_password()’s.
+    """
+    characters = password_letters + password_digits
+    if grouplength > len(characters):
+        raise ValueError("Sample larger than population.")
+
+    source = _characters(characters)
+    digits = _characters(password_digits)
+
+    def make(count):
+        ret = []
+        for a in range(count):
+            groups = []
+            for b in range(groupnum):
+                # Characters do not repeat within a group.
+                group = ""
+                while len(group) < grouplength:
+                    for char in source.take(grouplength - len(group)):
+                        if char not in group:
+                            group += char
+                groups.append(group)
+
+            password = "-".join(groups)
+            for d in password_digits:
+                if d in password:
+                    break
+            else:
+                # Force a digit in the password; one at the end.
+                password = password[:-1] + digits.take(1)
+            ret.append(password)
+
+        return ret
+
+    if groupnum == 0 or grouplength == 0:
+        possible = len(password_digits) # Just the forced digit.
     else:
-        # Force a digit in the password; one at the end.
-        return ret[:-1] + random.sample(digits, 1)[0]
-    
+        # Every group a sequence of different characters, and a digit
+        # somewhere.
+        possible = ( math.perm(len(characters), grouplength) ** groupnum
+                     - math.perm(len(password_letters), grouplength)
+                       ** groupnum )
+
+    return _batch(n, make, unique, possible)
+
+def apple_style_random_password(groupnum=4, grouplength=3):
+    return apple_style_random_passwords(1, groupnum, grouplength)[0]
     
 
 password_specials = "+-/*!&;$,@"
+def random_passwords(n, length=8, use_specials=True, unique=False):
+    """
+    Return a list of `n` passwords like random_password()’s, drawn from
+    the operating system’s cryptographically secure random source.
+    """
+    letters = _characters(password_letters)
+    characters = _characters(password_letters + password_digits)
+    specials = _characters(password_specials)
+
+    rest = max(length - 1, 0)
+    with_special = use_specials and length > 2
+
+    def make(count):
+        firsts = letters.take(count)
+        rests = characters.take(count * rest)
+
+        if not with_special:
+            return [ firsts[a] + rests[a*rest:(a+1)*rest]
+                     for a in range(count) ]
+        else:
+            specials_ = specials.take(count)
+            ret = []
+            for a in range(count):
+                password = firsts[a] + rests[a*rest:(a+1)*rest-1]
+                idx = secrets.randbelow(length-2) + 1
+                ret.append(password[:idx] + specials_[a] + password[idx:])
+            return ret
+
+    if with_special:
+        possible = ( len(password_letters)
+                     * (len(password_letters) + len(password_digits))
+                       ** (length - 2)
+                     * (length - 2) * len(password_specials) )
+    else:
+        possible = ( len(password_letters)
+                     * (len(password_letters) + len(password_digits))
+                       ** rest )
+
+    return _batch(n, make, unique, possible)
+
 def random_password(length=8, use_specials=True):
-    letters = "ABCDEFGHJKLMNPQRSTUVWYXZabcdefghijkmnpqrstuvwyxz"
-    digits = "0123456789"
-    characters = letters + digits
+    return random_passwords(1, length, use_specials)[0]
 
-    ret = []
-    ret.append(random.choice(letters))
-    for a in range(length-1):
-        ret.append(random.choice(characters))
-
-    if use_specials and length > 2:
-        ret = ret[:-1]
-        idx = random.randint(1, length-2)
-        ret.insert(idx, random.choice(password_specials))
-            
-    return "".join(ret)
-
-def password_good_enough(password):
+# Bits for the character classes password_good_enough() requires.
+_password_classes = {}
+for flag, characters in enumerate( ( "ABCDEFGHJKLMNPQRSTUVWYXZ",
+                                     "abcdefghijkmnpqrstuvwyxz",
+                                     "0123456789",
+                                     password_specials, ) ):
+    for char in characters:
+        _password_classes[char] = 1 << flag
+_all_password_classes = 15
+
+def password_good_enough(password, breach_filter=None):
+    """
+    Is `password` at least 8 characters long and does it contain an
+    upper and a lower case letter, a digit and one of the
+    password_specials? If a `breach_filter` is given, the password must
+    not be in it, either.
+    """
     if len(password) < 8:
         return False
-        
-    def contains_one_of(s):
-        for a in s:
-            if a in password:
-                return True
-        else:
-            return False
 
-    return contains_one_of("ABCDEFGHJKLMNPQRSTUVWYXZ") and \
-        contains_one_of("abcdefghijkmnpqrstuvwyxz") and \
-        contains_one_of("0123456789") and \
-        contains_one_of(password_specials) 
+    flags = 0
+    for char in password:
+        flags |= _password_classes.get(char, 0)
+        if flags == _all_password_classes:
+            break
+    else:
+        return False
+
+    if breach_filter is not None and password in breach_filter:
+        return False
+
+    return True
+
+class breach_filter:
+    """
+    A Bloom filter of known breached passwords, memory-mapped from a file
+    built by build_breach_filter(). Mapping it is cheap and the pages are
+    shared between all processes that use the same file.
+
+    Passwords are hashed with SHA-1, so the filter can be built from the
+    hash lists breach databases publish. Membership tests may yield
+    false positives at the rate the filter was built for, but no false
+    negatives.
+    """
+    magic = b"t4bloom1"
+    header = struct.Struct("<8sQI")
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.bits, self.hashes = self.header.unpack_from(self.mmap)
+        if magic != self.magic:
+            raise ValueError("Not a breach_filter file: %s" % path)
+
+    @staticmethod
+    def digest(password):
+        return hashlib.sha1(password.encode("utf-8")).digest()
+
+    def contains_digest(self, digest):
+        bits = self.bits
+        offset = self.header.size
+        mm = self.mmap
+
+        for idx in _bloom_indices(digest, bits, self.hashes):
+            if not mm[offset + (idx >> 3)] & (1 << (idx & 7)):
+                return False
+        return True
+
+    def __contains__(self, password):
+        return self.contains_digest(self.digest(password))
+
+    def check_many(self, passwords):
+        """
+        Return a list of bools telling which of the `passwords` are in
+        the filter, e.g. for auditing existing accounts. The passwords may
+        also be SHA-1 digests (as bytes).
+        """
+        digest = self.digest
+        contains_digest = self.contains_digest
+        return [ contains_digest(p if isinstance(p, bytes) else digest(p))
+                 for p in passwords ]
+
+    def close(self):
+        self.mmap.close()
+
+def _bloom_indices(digest, bits, hashes):
+    """
+    The `hashes` bit positions for a SHA-1 digest by double hashing.
+    """
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:16], "little") | 1
+    for i in range(hashes):
+        yield (h1 + i * h2) % bits
+
+def build_breach_filter(path, source, expected_count,
+                        false_positive_rate=0.001, hashed=False):
+    """
+    Write a breach_filter file to `path` from `source`, an iterable of
+    lines or the path of a text file. Lines are plaintext passwords, or
+    SHA-1 hex digests if `hashed` is true, optionally followed by “:”
+    and a count as in the Pwned Passwords lists. The filter is sized for
+    `expected_count` entries at `false_positive_rate` and written through
+    a memory map, so the source is streamed and never held in memory.
+    """
+    if isinstance(source, str):
+        with open(source, encoding="utf-8", errors="replace") as fp:
+            return build_breach_filter(path, fp, expected_count,
+                                       false_positive_rate, hashed)
+
+    expected_count = max(expected_count, 1)
+    bits = math.ceil(-expected_count * math.log(false_positive_rate)
+                     / math.log(2)**2)
+    bits = max(bits, 64)
+    hashes = max(1, round(bits / expected_count * math.log(2)))
+
+    header = breach_filter.header
+    offset = header.size
+    with open(path, "w+b") as fp:
+        fp.truncate(offset + (bits + 7) // 8)
+        with mmap.mmap(fp.fileno(), 0) as mm:
+            header.pack_into(mm, 0, breach_filter.magic, bits, hashes)
+
+            for line in source:
+                line = line.rstrip("\r\n")
+                if hashed:
+                    line = line.split(":", 1)[0].strip()
+                    if not line:
+                        continue
+                    digest = bytes.fromhex(line)
+                else:
+                    digest = breach_filter.digest(line)
+
+                for idx in _bloom_indices(digest, bits, hashes):
+                    mm[offset + (idx >> 3)] |= 1 << (idx & 7)
+
+def slugs(n, length=10, unique=False):
+    """
+    Return a list of `n` random slugs of `length` letters and digits.
+    """
+    return random_passwords(n, length, False, unique)
 
 def slug(length=10):
     return random_password(length, False)
+
+
+# Password hashing. Hashes are stored in a self-describing format,
+# $<method>$<parameters>$<salt>$<hash>, with salt and hash Base64
+# encoded (without padding), e.g.
+#
+#   $scrypt$ln=15,r=8,p=1$…$…
+#   $pbkdf2-sha256$i=600000$…$…
+
+default_password_hash_method = "scrypt"
+default_password_hash_cost = { "scrypt": { "ln": 15, "r": 8, "p": 1, },
+                               "pbkdf2-sha256": { "i": 600000, }, }
+
+def _b64encode(data):
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+def _b64decode(s):
+    return base64.b64decode(s + "=" * (-len(s) % 4))
+
+def _password_hash(method, password, salt, cost):
+    password = password.encode("utf-8")
+
+    if method == "scrypt":
+        n, r, p = 1 << cost["ln"], cost["r"], cost["p"]
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                              maxmem=128 * r * (n + p + 2) + 2**20,
+                              dklen=32)
+    elif method == "pbkdf2-sha256":
+        return hashlib.pbkdf2_hmac("sha256", password, salt, cost["i"])
+    else:
+        raise ValueError("Unknown password hash method: %s" % repr(method))
+
+def hash_password(password, method=None, **cost):
+    """
+    Hash `password` with a random salt and return the encoded hash.
+    `method` is "scrypt" (the default) or "pbkdf2-sha256"; the keyword
+    arguments override default_password_hash_cost[method].
+    """
+    if method is None:
+        method = default_password_hash_method
+    cost = dict(default_password_hash_cost[method], **cost)
+
+    salt = os.urandom(16)
+    hash = _password_hash(method, password, salt, cost)
+
+    return "$%s$%s$%s$%s" % ( method,
+                              ",".join("%s=%i" % kv for kv in cost.items()),
+                              _b64encode(salt), _b64encode(hash), )
+
+def parse_password_hash(encoded):
+    """
+    Return ( method, cost, salt, hash, ) for an encoded password hash.
+    """
+    try:
+        empty, method, cost, salt, hash = encoded.split("$")
+        cost = { key: int(value) for key, value in
+                 ( pair.split("=") for pair in cost.split(",") ) }
+        return ( method, cost, _b64decode(salt), _b64decode(hash), )
+    except ValueError:
+        raise ValueError("Not an encoded password hash: %s" % repr(encoded))
+
+def verify_password(password, encoded):
+    """
+    Does `password` match the `encoded` hash?
+    """
+    method, cost, salt, hash = parse_password_hash(encoded)
+    return hmac.compare_digest(_password_hash(method, password, salt, cost),
+                               hash)
+
+def needs_rehash(encoded, method=None, **cost):
+    """
+    Was `encoded` made with a different method or cost than
+    hash_password(password, method, **cost) would use now?
+    """
+    if method is None:
+        method = default_password_hash_method
+    cost = dict(default_password_hash_cost[method], **cost)
+
+    old_method, old_cost, salt, hash = parse_password_hash(encoded)
+    return old_method != method or old_cost != cost
+
+def verify_and_update(password, encoded, method=None, **cost):
+    """
+    Verify `password` at login time. Return ( valid, new_hash, ), where
+    new_hash is a fresh hash with the current method and cost if the
+    password is valid but `encoded` is outdated, and None otherwise.
+    """
+    if not verify_password(password, encoded):
+        return ( False, None, )
+    elif needs_rehash(encoded, method, **cost):
+        return ( True, hash_password(password, method, **cost), )
+    else:
+        return ( True, None, )
+
+# Hashing is slow on purpose. To keep it from tying up the threads that
+# serve requests, the submit_*() and async_*() functions run it in a
+# thread pool of this size. hashlib releases the GIL while hashing.
+password_hash_workers = os.cpu_count() or 2
+
+_password_hash_pool = None
+_password_hash_pool_lock = threading.Lock()
+
+def password_hash_pool():
+    global _password_hash_pool
+
+    with _password_hash_pool_lock:
+        if _password_hash_pool is None:
+            import concurrent.futures
+            _password_hash_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=password_hash_workers,
+                thread_name_prefix="password hashing")
+        return _password_hash_pool
+
+def submit_hash_password(password, method=None, **cost):
+    """
+    Run hash_password() in the pool and return a
+    concurrent.futures.Future.
+    """
+    return password_hash_pool().submit(hash_password, password,
+                                       method, **cost)
+
+def submit_verify_password(password, encoded):
+    return password_hash_pool().submit(verify_password, password, encoded)
+
+def submit_verify_and_update(password, encoded, method=None, **cost):
+    return password_hash_pool().submit(verify_and_update, password, encoded,
+                                       method, **cost)
+
+async def async_hash_password(password, method=None, **cost):
+    import asyncio
+    return await asyncio.wrap_future(
+        submit_hash_password(password, method, **cost))
+
+async def async_verify_password(password, encoded):
+    import asyncio
+    return await asyncio.wrap_future(
+        submit_verify_password(password, encoded))
+
+async def async_verify_and_update(password, encoded, method=None, **cost):
+    import asyncio
+    return await asyncio.wrap_future(
+        submit_verify_and_update(password, encoded, method, **cost))
+
+def calibrate_password_hash(target_seconds=0.1, method=None):
+    """
+    Return the highest cost for `method` (as a dict for hash_password())
+    for which hashing a password on this machine takes no longer than
+    `target_seconds`, but at least the smallest cost tried.
+    """
+    if method is None:
+        method = default_password_hash_method
+
+    if method == "scrypt":
+        key, value, step = "ln", 10, lambda ln: ln + 1
+    else:
+        key, value, step = "i", 10000, lambda i: i * 2
+
+    cost = dict(default_password_hash_cost[method])
+    best = value
+    while True:
+        cost[key] = value
+        start = time.perf_counter()
+        _password_hash(method, "calibration", b"0123456789abcdef", cost)
+        if time.perf_counter() - start > target_seconds:
+            break
+        best = value
+        value = step(value)
+
+    cost[key] = best
+    return cost
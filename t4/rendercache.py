@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+A cache for the output of text transformations like
+t4.typography.improve_typography(), keyed by a hash of the input text,
+the name of the transformation and its options. Results are kept in an
+in-process LRU tier and, optionally, in an SQLite database that several
+processes may share. Both tiers are limited by the total length of the
+results they hold; the least recently used results are evicted first.
+
+t4.typography.enable_render_cache() sets one up for improve_typography()
+and add_web_paragraphs().
+"""
+
+import os, threading, hashlib, time, collections, sqlite3
+
+class render_cache:
+    def __init__(self, max_size=32*1024*1024, path=None,
+                 disk_max_size=512*1024*1024, min_length=512):
+        """
+        `max_size` and `disk_max_size` limit the total length (in
+        characters) of the results kept in memory and in the database at
+        `path`, respectively. Without a `path`, there is no disk tier.
+        Texts shorter than `min_length` are transformed rather than
+        looked up: Hashing them does not save much.
+        """
+        self.max_size = max_size
+        self.path = path
+        self.disk_max_size = disk_max_size
+        self.min_length = min_length
+
+        self._memory = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if path is not None:
+            self._local = threading.local()
+            self._inherited = []
+            db = self._db()
+            db.execute("CREATE TABLE IF NOT EXISTS renders ("
+                       "  key TEXT PRIMARY KEY,"
+                       "  result TEXT NOT NULL,"
+                       "  size INTEGER NOT NULL,"
+                       "  last_used REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS renders_last_used "
+                       "ON renders (last_used)")
+            self._disk_size, = db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM renders").fetchone()
+
+    def _db(self):
+        # One connection per thread and process. In WAL mode readers don’t
+        # block the writer in another process and vice versa.
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            if db is not None:
+                # Opened by the process we were forked from. SQLite must
+                # not use it here, not even to close it.
+                self._inherited.append(db)
+
+            db = sqlite3.connect(self.path, timeout=10,
+                                 isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def key(self, name, options, text):
+        h = hashlib.blake2b(text.encode("utf-8", "surrogatepass"),
+                            digest_size=16, person=b"t4render")
+        h.update(repr( (name, options,) ).encode("utf-8"))
+        return h.hexdigest()
+
+    def render(self, name, options, text, function):
+        """
+        Return function(text), from the cache if possible. `options`
+        must be a tuple of all the arguments besides `text` that change
+        the result.
+        """
+        if len(text) < self.min_length:
+            return function(text)
+
+        key = self.key(name, options, text)
+
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return result
+
+        if self.path is not None:
+            result = self._disk_get(key)
+            if result is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._memory_put(key, result)
+                return result
+
+        result = function(text)
+        with self._lock:
+            self.misses += 1
+
+        self._memory_put(key, result)
+        if self.path is not None:
+            self._disk_put(key, result)
+
+        return result
+
+    def _memory_put(self, key, result):
+        size = len(result)
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+
+            self._memory[key] = result
+            self._size += size
+
+            while self._size > self.max_size:
+                evicted_key, evicted = self._memory.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _disk_get(self, key):
+        db = self._db()
+        row = db.execute("SELECT result FROM renders WHERE key = ?",
+                         ( key, )).fetchone()
+        if row is None:
+            return None
+
+        db.execute("UPDATE renders SET last_used = ? WHERE key = ?",
+                   ( time.time(), key, ))
+        return row[0]
+
+    def _disk_put(self, key, result):
+        size = len(result)
+        if size > self.disk_max_size:
+            return
+
+        db = self._db()
+        db.execute("INSERT OR REPLACE INTO renders "
+                   "(key, result, size, last_used) VALUES (?, ?, ?, ?)",
+                   ( key, result, size, time.time(), ))
+
+        with self._lock:
+            self._disk_size += size
+            evict = self._disk_size > self.disk_max_size
+
+        if evict:
+            self._disk_evict()
+
+    def _disk_evict(self):
+        """
+        Delete the least recently used results until those left take up
+        no more than 90% of disk_max_size. Other processes add to the
+        database, too, so the total is re-calculated first.
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            total, = db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM renders").fetchone()
+            excess = total - self.disk_max_size * 9 // 10
+
+            doomed = []
+            if excess > 0:
+                for key, size in db.execute("SELECT key, size FROM renders "
+                                            "ORDER BY last_used"):
+                    doomed.append( (key,) )
+                    excess -= size
+                    total -= size
+                    if excess <= 0:
+                        break
+
+                db.executemany("DELETE FROM renders WHERE key = ?", doomed)
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+        with self._lock:
+            self._disk_size = total
+
+    def stats(self):
+        """
+        Return a dict of hit and miss counts and sizes.
+        """
+        with self._lock:
+            ret = { "memory_hits": self.memory_hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "memory_entries": len(self._memory),
+                    "memory_size": self._size, }
+
+        if self.path is not None:
+            ret["disk_size"] = self._disk_size
+
+        return ret
+
+    def clear(self):
+        """
+        Empty both tiers and reset the counters.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._size = 0
+            self.memory_hits = self.disk_hits = self.misses = 0
+
+        if self.path is not None:
+            self._db().execute("DELETE FROM renders")
+            with self._lock:
+                self._disk_size = 0
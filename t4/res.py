@@ -23,13 +23,55 @@
 ##
 ##  I have added a copy of the GPL in the file gpl.txt.
 
-import re
+import re, collections
 domain_name_re = re.compile("(?:[0-9a-z](?:[-0-9a-z]*[0-9a-z])?\.)+[a-z]{2,6}")
 local_part_re = re.compile(r"[-A-Za-z0-9!#$%&'\*+/=\?^_`\{|\}~\.]+")
 
 email_re = re.compile(r"(?:[-A-Za-z0-9!#$%&'\*+/=\?^_`\{|\}~]\.?)*[-A-Za-z0-9!#$%&'\*+/=\?^_`\{|\}~]@(?:[0-9a-zA-Z](?:[-0-9a-zA-Z]*[0-9a-zA-Z])?\.)+[a-zA-Z]{2,4}")
 email_re_groups = re.compile(r"((?:[-A-Za-z0-9!#$%&'\*+/=\?^_`\{|\}~]\.?)*[-A-Za-z0-9!#$%&'\*+/=\?^_`\{|\}~])@((?:[0-9a-zA-Z](?:[-0-9a-zA-Z]*[0-9a-zA-Z])?\.)+[a-zA-Z]{2,4})")
 
+_ascii_letters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_domain_chars = _ascii_letters + "0123456789-"
+_local_part_chars = _ascii_letters + "0123456789-!#$%&'*+/=?^_`{|}~."
+
+def is_valid_email_address(address):
+    """
+    Is all of `address` an e-mail address email_re accepts? Other than
+    email_re, this allows any top level domain that starts with two
+    letters, like .museum or .xn--p1ai. Checked with a few linear scans,
+    so it takes linear time whatever the input.
+    """
+    if not isinstance(address, str):
+        raise TypeError("Expected a str, not %s" % repr(type(address)))
+
+    local_part, at, domain = address.partition("@")
+    if ( not local_part
+         or local_part.strip(_local_part_chars)
+         or local_part[0] == "." or local_part[-1] == "."
+         or ".." in local_part ):
+        return False
+
+    labels = domain.split(".")
+    if len(labels) < 2:
+        return False
+
+    for label in labels:
+        if ( not label or label.strip(_domain_chars)
+             or label[0] == "-" or label[-1] == "-" ):
+            return False
+
+    tld = labels[-1]
+    return len(tld) >= 2 and not tld[:2].strip(_ascii_letters)
+
+def invalid_email_addresses(addresses):
+    """
+    Return a list of ( index, address, ) tuples for the addresses in
+    `addresses` is_valid_email_address() rejects.
+    """
+    return [ ( index, address, )
+             for index, address in enumerate(addresses)
+             if not is_valid_email_address(address) ]
+
 dotted_quad_re = re.compile(r"(?:\d{1,3})\.(?:\d{1,3})\.(?:\d{1,3})\.(?:\d{1,3})")
 dotted_quad_re_groups = re.compile(dotted_quad_re.pattern.replace("?:", ""))
 
@@ -42,3 +84,78 @@ ip_v4_address_with_mask_re_groups = re.compile(
 http_url_re = re.compile("https?://(?:[0-9a-z](?:[0-9a-z-]*[0-9a-z])?\.)+[a-z]{2,6}(/.*)?")
 
 login_re = re.compile(r"^[a-zA-Z0-9_][-a-zA-Z0-9_\.]+$")
+
+# The patterns scan_entities() looks for, in order of precedence.
+entity_patterns = { "http_url": http_url_re,
+                    "email": email_re_groups,
+                    "ip_v4_address": ip_v4_address_with_mask_re_groups,
+                    "domain_name": domain_name_re, }
+
+entity_match = collections.namedtuple("entity_match",
+                                      ( "kind", "text", "span", "groups", ))
+
+_entity_scanners = {}
+def _entity_scanner(kinds):
+    """
+    Return a regular expression that combines the entity_patterns for
+    `kinds` into one alternation and a list of ( kind, first group, last
+    group, ) tuples to pull the groups out of its matches.
+    """
+    ret = _entity_scanners.get(kinds)
+    if ret is None:
+        alternatives = []
+        groups = []
+        index = 1
+        for kind in kinds:
+            regex = entity_patterns[kind]
+            alternatives.append("(?P<%s>%s)" % ( kind, regex.pattern, ))
+            groups.append( (kind, index + 1, index + 1 + regex.groups,) )
+            index += 1 + regex.groups
+
+        ret = ( re.compile("|".join(alternatives)), groups, )
+        _entity_scanners[kinds] = ret
+
+    return ret
+
+def scan_entities(source, kinds=tuple(entity_patterns.keys()),
+                  chunk_size=64*1024):
+    """
+    Find all URLs, e-mail addresses, IPv4 addresses (with optional /mask)
+    and domain names in `source` in a single pass and yield an
+    entity_match for each. `source` is a str or a file-like object
+    which is read `chunk_size` characters at a time. Spans are relative
+    to the whole source.
+
+    None of the patterns matches across a newline, so the text is
+    scanned a line at a time. Memory use is bounded by the longest line.
+    """
+    regex, groups = _entity_scanner(tuple(kinds))
+    groups = { kind: ( first, last, ) for kind, first, last in groups }
+
+    def matches(text, offset):
+        for match in regex.finditer(text):
+            kind = match.lastgroup
+            first, last = groups[kind]
+            start, end = match.span()
+            yield entity_match(kind, match.group(),
+                               ( start + offset, end + offset, ),
+                               match.groups()[first-1:last-1])
+
+    if isinstance(source, str):
+        yield from matches(source, 0)
+    else:
+        offset = 0
+        rest = ""
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+
+            text = rest + chunk
+            cut = text.rfind("\n") + 1
+            if cut:
+                yield from matches(text[:cut], offset)
+                offset += cut
+            rest = text[cut:]
+
+        yield from matches(rest, offset)
@@ -26,61 +26,265 @@
 ##  I have added a copy of the GPL in the file COPYING
 
 
-import sys, os, os.path as op, types, smtplib, socket, subprocess
+import sys, os, os.path as op, types, threading, time, importlib
+import re, codecs, base64, mmap, string
+from contextlib import contextmanager, nullcontext
 
+from t4.res import is_valid_email_address, invalid_email_addresses
+
+# No longer used here, but kept so `from t4.sendmail import email_re`
+# still works.
 from t4.res import email_re
 
-try:
-    from ll.xist import xsc
-except ImportError:
-    xsc = None
-
-from email import encoders
-from email.message import Message
-from email.mime.base import MIMEBase
-from email.mime.audio import MIMEAudio
-from email.mime.base import MIMEBase
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.utils import formataddr
-from email.header import Header
-
-# Send UTF-8 text parts encoded Quoted Printable (rather than base64)
+# Send UTF-8 text parts encoded Quoted Printable (rather than base64). This
+# is done on import, so it applies to messages built outside this module,
+# too. email.charset itself is quick to import.
 from email import charset
 charset.add_charset("utf-8", charset.SHORTEST, charset.QP)
 
+# smtplib, socket, subprocess, uuid, mimetypes and the email package take
+# a while to import. They are imported where they are used, and the email
+# package’s names by _load_email(). Both are still available as module
+# attributes through __getattr__().
+_lazy_modules = { "smtplib", "socket", "subprocess", "uuid", "mimetypes", }
+_email_names = { "encoders", "Message", "MIMEBase", "MIMEAudio", "MIMEImage",
+                 "MIMEMultipart", "MIMEText", "formataddr", "Header", }
+
+def _load_email():
+    global encoders, Message, MIMEBase, MIMEAudio, MIMEImage, MIMEMultipart
+    global MIMEText, formataddr, Header
+
+    # Header is imported last, so everything is in place once it is.
+    if "Header" in globals():
+        return
+
+    from email import encoders
+    from email.message import Message
+    from email.mime.base import MIMEBase
+    from email.mime.audio import MIMEAudio
+    from email.mime.image import MIMEImage
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.utils import formataddr
+    from email.header import Header
+
+def __getattr__(name):
+    if name in _email_names:
+        _load_email()
+        return globals()[name]
+    elif name in _lazy_modules:
+        return importlib.import_module(name)
+    elif name == "xsc":
+        try:
+            from ll.xist import xsc
+        except ImportError:
+            xsc = None
+        return xsc
+    else:
+        raise AttributeError("module %r has no attribute %r" % ( __name__,
+                                                                 name, ))
+
 
 class sendmail_attachment:
-    def __init__(self, filename, data, mime_type=None,
-                 content_disposition="attachment", headers={}):
+    """
+    An attachment for sendmail(). `data` may be a str or bytes, a binary
+    (or, for text/* attachments, text) file-like object or an mmap.
+    Alternatively, pass the `path` of a file to attach.
+
+    Except for text attachments supplied as str or bytes, attachments are
+    encoded piece by piece while the message is being written to the
+    transport, so they are never held in memory as a whole. A file-like
+    object that is not seekable can only be sent once. Streamed text/*
+    attachments are sent as UTF-8 if they are, and base64 encoded
+    without a charset otherwise.
+    """
+    # Bytes read at a time for Base64 encoding. A multiple of 57, so each
+    # chunk encodes to complete 76 character lines.
+    base64_chunk_size = 57 * 1024
+
+    # Characters read at a time for QP encoding.
+    text_chunk_size = 64 * 1024
+
+    def __init__(self, filename, data=None, mime_type=None,
+                 content_disposition="attachment", headers={}, path=None):
+        if data is None and path is None:
+            raise TypeError("A sendmail_attachment needs data or a path.")
+
         self.filename = filename
         self.data = data
+        self.path = path
 
         if mime_type is None:
-            mime_type, encoding = mimetypes.guress_type(filename)
-            if mime_type is None or encoding is None:
+            import mimetypes
+            mime_type, encoding = mimetypes.guess_type(filename)
+            if mime_type is None or encoding is not None:
                 mime_type = "application/octet-stream"
                 
         self.mime_type = mime_type
         self.content_disposition = content_disposition
         self.headers = headers
 
+        if hasattr(data, "seekable") and data.seekable():
+            self._start = data.tell()
+        else:
+            self._start = None
+        self._read = False
+
+        # Whether a streamed text/* attachment is sent as UTF-8 QP, set
+        # by placeholder_part().
+        self._utf8 = None
+
+    @property
+    def repeatable(self):
+        """
+        Can the attachment be read more than once?
+        """
+        return ( self.path is not None
+                 or self._start is not None
+                 or not hasattr(self.data, "read")
+                 or isinstance(self.data, mmap.mmap) )
+
+    @property
+    def streamed(self):
+        """
+        Will this attachment be encoded while the message is written?
+        """
+        return ( not self.mime_type.startswith("text/")
+                 or not isinstance(self.data, (str, bytes,)) )
+
+    def _read_chunks(self, size):
+        """
+        Yield the attachment’s raw data in chunks of `size` bytes (or
+        characters) as they come from the source, the last one possibly
+        shorter.
+        """
+        if self.path is not None:
+            fp = open(self.path, "rb")
+        elif ( hasattr(self.data, "read")
+               and not isinstance(self.data, mmap.mmap) ):
+            fp = self.data
+            if self._start is not None:
+                fp.seek(self._start)
+            elif self._read:
+                raise IOError("The non-seekable data of attachment %s has "
+                              "been read already." % repr(self.filename))
+            self._read = True
+        else:
+            # str, bytes, bytearray, memoryview or mmap.
+            data = self.data
+            if not isinstance(data, str):
+                data = memoryview(data)
+            for a in range(0, len(data), size):
+                yield data[a:a+size]
+            return
+
+        try:
+            buffer = []
+            buffered = 0
+            while True:
+                # read() may return less than asked for.
+                data = fp.read(size - buffered)
+                if not data:
+                    break
+                buffer.append(data)
+                buffered += len(data)
+                if buffered == size:
+                    yield buffer[0][:0].join(buffer)
+                    buffer = []
+                    buffered = 0
+            if buffer:
+                yield buffer[0][:0].join(buffer)
+        finally:
+            if self.path is not None:
+                fp.close()
+
+    def read(self):
+        """
+        Return the attachment’s data in one piece.
+        """
+        chunks = list(self._read_chunks(self.base64_chunk_size))
+        if not chunks:
+            return b""
+        elif isinstance(chunks[0], memoryview):
+            return b"".join(chunks)
+        else:
+            return chunks[0][:0].join(chunks)
+
     def part(self):
+        """
+        Return the attachment as a MIME part, encoded in memory.
+        """
+        _load_email()
+
+        data = self.data
+        if not isinstance(data, (str, bytes,)):
+            data = self.read()
+
         maintype, subtype = self.mime_type.split("/", 1)
         if maintype == "text":
             # Note: we should handle calculating the charset
-            msg = MIMEText(self.data, _subtype=subtype)
+            msg = MIMEText(data, _subtype=subtype)
         elif maintype == "image":
-            msg = MIMEImage(self.data, _subtype=subtype)
+            msg = MIMEImage(data, _subtype=subtype)
         elif maintype == "audio":
-            msg = MIMEAudio(self.data, _subtype=subtype)
+            msg = MIMEAudio(data, _subtype=subtype)
         else:
             msg = MIMEBase(maintype, subtype)
-            msg.set_payload(self.data)
+            msg.set_payload(data)
             # Encode the payload using Base64
             encoders.encode_base64(msg)
-            
+
+        self._add_headers(msg)
+        return msg
+
+    def placeholder_part(self, token):
+        """
+        Return a MIME part with this attachment’s headers and `token` as
+        its payload, for composed_message to replace with the output of
+        encoded_chunks().
+        """
+        _load_email()
+
+        maintype, subtype = self.mime_type.split("/", 1)
+        msg = MIMEBase(maintype, subtype)
+        if maintype == "text":
+            self._utf8 = self._is_utf8()
+
+        if self._utf8:
+            msg.set_param("charset", "utf-8")
+            msg["Content-Transfer-Encoding"] = "quoted-printable"
+        else:
+            msg["Content-Transfer-Encoding"] = "base64"
+        msg.set_payload(token)
+
+        self._add_headers(msg)
+        return msg
+
+    def _is_utf8(self):
+        """
+        Can this text attachment be sent as UTF-8? Binary data is read
+        once to find out, so that data in another encoding doesn’t fail
+        in the middle of delivery. A non-seekable binary stream can’t be
+        checked and is sent base64 encoded, without a charset, like data
+        that is not UTF-8.
+        """
+        if self.path is None and hasattr(self.data, "read"):
+            if isinstance(self.data.read(0), str):
+                return True
+            elif not self.repeatable:
+                return False
+
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        try:
+            for chunk in self._read_chunks(self.base64_chunk_size):
+                decoder.decode(chunk)
+            decoder.decode(b"", True)
+        except UnicodeDecodeError:
+            return False
+        else:
+            return True
+
+    def _add_headers(self, msg):
         # Set the filename parameter
         msg.add_header("Content-Disposition",
                        self.content_disposition,
@@ -88,23 +292,612 @@ class sendmail_attachment:
 
         for key, value in self.headers.items():
             msg.add_header(key, value)
-        
-        return msg
 
-    
+    def encoded_chunks(self):
+        """
+        Yield the encoded payload in pieces: Base64 for binary data and
+        Quoted Printable UTF-8 for text.
+        """
+        if self._utf8:
+            _load_email()
+            encoder = charset.Charset("utf-8")
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            rest = ""
+            for chunk in self._read_chunks(self.text_chunk_size):
+                if not isinstance(chunk, str):
+                    chunk = decoder.decode(chunk)
+
+                # QP encodes line by line, so we may cut after any \n.
+                chunk = rest + chunk
+                cut = chunk.rfind("\n") + 1
+                rest = chunk[cut:]
+                if cut:
+                    yield encoder.body_encode(chunk[:cut])
+
+            rest += decoder.decode(b"", True)
+            if rest:
+                yield encoder.body_encode(rest)
+        else:
+            for chunk in self._read_chunks(self.base64_chunk_size):
+                yield base64.encodebytes(chunk).decode("ascii")
+
+_placeholder_re = re.compile(r"(t4-attachment-[0-9a-f]{32})")
+
+class composed_message:
+    """
+    A message as returned by compose(). `message` is the
+    email.message.Message. Iterating over a composed_message yields its
+    text in pieces, encoding streamed attachments as it goes, so it can be
+    written to a transport without ever being in memory as a whole.
+    """
+    def __init__(self, message, streams={}):
+        self.message = message
+
+        # Maps placeholder tokens to sendmail_attachment objects.
+        self.streams = streams
+
+    def __iter__(self):
+        text = self.message.as_string()
+        if not self.streams:
+            yield text
+        else:
+            for piece in _placeholder_re.split(text):
+                if piece in self.streams:
+                    yield from self.streams[piece].encoded_chunks()
+                elif piece:
+                    yield piece
+
+    @property
+    def repeatable(self):
+        return all(a.repeatable for a in self.streams.values())
+
+    def as_string(self):
+        return "".join(self)
+
+def _repeatable(message):
+    """
+    Can `message` be iterated over again, to re-try its delivery?
+    """
+    if isinstance(message, str):
+        return True
+    else:
+        return getattr(message, "repeatable", iter(message) is not message)
+
+class sendmail_binary_transport:
+    """
+    Deliver messages by piping them into the local sendmail binary, one
+    process per message.
+    """
+    def __init__(self, path="/usr/sbin/sendmail"):
+        self.path = path
+
+    def deliver(self, envelope_from, recipients, message):
+        """
+        `message` is a str or an iterable of str pieces, like a
+        composed_message.
+        """
+        import subprocess
+
+        if isinstance(message, str):
+            message = [ message, ]
+
+        process = subprocess.Popen(
+            [self.path,
+             "-f", envelope_from] # Set the envelope sender.
+            + list(recipients),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding="utf-8")
+
+        try:
+            for chunk in message:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass # communicate() will tell us what went wrong.
+        except:
+            process.kill()
+            process.wait()
+            raise
+
+        stdout, stderr = process.communicate()
+        if process.returncode != 0: raise IOError(stderr)
+
+    def close(self):
+        pass
+
+class smtp_transport:
+    """
+    Deliver messages through an SMTP relay, keeping a pool of up to
+    `pool_size` open (and, if `username` is set, authenticated)
+    connections around between messages. A connection that has been idle
+    for more than `keepalive` seconds is checked with a NOOP before it is
+    re-used. A connection the server dropped is replaced and the message
+    re-tried once.
+    """
+    def __init__(self, host, port=25, username=None, password=None,
+                 starttls=False, ssl=False, pool_size=4, keepalive=60,
+                 timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.ssl = ssl
+        self.keepalive = keepalive
+        self.timeout = timeout
+
+        self._idle = [] # ( connection, last used, ) tuples.
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _connect(self):
+        import smtplib
+
+        if self.ssl:
+            connection = smtplib.SMTP_SSL(self.host, self.port,
+                                          timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(self.host, self.port,
+                                      timeout=self.timeout)
+
+        try:
+            if self.starttls:
+                connection.starttls()
+            if self.username is not None:
+                connection.login(self.username, self.password)
+        except:
+            connection.close()
+            raise
+
+        return connection
+
+    def _alive(self, connection, last_used):
+        import smtplib
+
+        if time.monotonic() - last_used < self.keepalive:
+            return True
+
+        try:
+            return connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that checks a connection out of the pool and
+        returns it when done. A connection that raised anything but an
+        SMTP error response is closed rather than returned.
+        """
+        import smtplib
+
+        with self._slots:
+            connection = None
+            while connection is None:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, last_used = self._idle.pop()
+
+                if not self._alive(connection, last_used):
+                    self._close(connection)
+                    connection = None
+
+            if connection is None:
+                connection = self._connect()
+
+            try:
+                yield connection
+            except (smtplib.SMTPRecipientsRefused,
+                    smtplib.SMTPResponseException):
+                # The server said no, but the connection is fine.
+                self._checkin(connection)
+                raise
+            except:
+                self._close(connection)
+                raise
+            else:
+                self._checkin(connection)
+
+    def _checkin(self, connection):
+        with self._lock:
+            self._idle.append( (connection, time.monotonic(),) )
+
+    def _close(self, connection):
+        import smtplib
+
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+    def deliver(self, envelope_from, recipients, message):
+        """
+        `message` is a str or an iterable of str pieces, like a
+        composed_message. The message is only re-tried on a dropped
+        connection if it can be iterated over again.
+        """
+        import smtplib
+
+        recipients = list(recipients)
+        retry = _repeatable(message)
+
+        for attempt in range(2):
+            try:
+                with self.connection() as connection:
+                    if isinstance(message, str):
+                        refused = _smtplib_sendmail(connection,
+                                                    envelope_from,
+                                                    recipients, message)
+                    else:
+                        refused = _smtp_sendmail_chunks(
+                            connection, envelope_from, recipients, message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                if attempt > 0 or not retry: raise
+            else:
+                break
+
+        if refused:
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection, last_used in idle:
+            self._close(connection)
+
+_eol_re = re.compile(r"\r\n|\r|\n")
+def _smtp_data(chunks):
+    """
+    Yield the DATA section of an SMTP transaction for the message in
+    `chunks` as bytes: CRLF line endings, leading dots doubled and the
+    final “.” line, like smtplib.SMTP.data() does for a whole message.
+    """
+    at_line_start = True
+    terminated = False
+    pending_cr = ""
+    for chunk in chunks:
+        chunk = pending_cr + chunk
+        if chunk.endswith("\r"):
+            # It might be half of a \r\n.
+            pending_cr = "\r"
+            chunk = chunk[:-1]
+        else:
+            pending_cr = ""
+
+        if not chunk:
+            continue
+
+        chunk = _eol_re.sub("\r\n", chunk)
+        if at_line_start and chunk.startswith("."):
+            chunk = "." + chunk
+        chunk = chunk.replace("\n.", "\n..")
+
+        at_line_start = chunk.endswith("\n")
+        terminated = chunk.endswith("\r\n")
+        yield chunk.encode("utf-8")
+
+    if pending_cr:
+        yield b"\r\n"
+    elif not terminated:
+        yield b"\r\n"
+
+    yield b".\r\n"
+
+def _rset(connection):
+    import smtplib
+
+    try:
+        connection.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+def _disconnected(code, response):
+    import smtplib
+
+    if isinstance(response, bytes):
+        response = response.decode("utf-8", "replace")
+    return smtplib.SMTPServerDisconnected("%i %s" % ( code, response, ))
+
+def _smtplib_sendmail(connection, envelope_from, recipients, message):
+    """
+    smtplib.SMTP.sendmail(), except that a 421 during RCPT raises
+    SMTPServerDisconnected, like _smtp_sendmail_chunks() does.
+    """
+    import smtplib
+
+    try:
+        return connection.sendmail(envelope_from, recipients, message)
+    except smtplib.SMTPRecipientsRefused as exc:
+        for code, response in exc.recipients.values():
+            if code == 421:
+                raise _disconnected(code, response)
+        raise
+
+def _smtp_sendmail_chunks(connection, envelope_from, recipients, chunks):
+    """
+    What smtplib.SMTP.sendmail() does, but sending the message from an
+    iterable of str pieces as they come.
+    """
+    import smtplib
+
+    connection.ehlo_or_helo_if_needed()
+
+    code, response = connection.mail(envelope_from)
+    if code != 250:
+        if code == 421:
+            connection.close()
+        else:
+            _rset(connection)
+        raise smtplib.SMTPSenderRefused(code, response, envelope_from)
+
+    refused = {}
+    for recipient in recipients:
+        code, response = connection.rcpt(recipient)
+        if code not in ( 250, 251, ):
+            refused[recipient] = ( code, response, )
+        if code == 421:
+            # The server is going away before DATA. Nobody got the
+            # message, so this must not look like a partial refusal.
+            connection.close()
+            raise _disconnected(code, response)
+
+    if len(refused) == len(recipients):
+        _rset(connection)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, response = connection.docmd("data")
+    if code != 354:
+        _rset(connection)
+        raise smtplib.SMTPDataError(code, response)
+
+    for data in _smtp_data(chunks):
+        connection.send(data)
+
+    code, response = connection.getreply()
+    if code != 250:
+        _rset(connection)
+        raise smtplib.SMTPDataError(code, response)
+
+    return refused
+
+# Hosts whose name starts with one of these keys deliver through the SMTP
+# relay named by the value instead of the local sendmail binary, unless
+# set_transport() was called.
+smtp_relays = { "leela.": "hermes.tux4web.de", }
+
+def verify_email_address(email):
+    if not is_valid_email_address(email):
+        raise ValueError("Not a valid e-mail address: %s" % repr(email))
+
+def verify_email_addresses(emails):
+    """
+    Raise a ValueError naming all of the invalid addresses in `emails`,
+    if there are any.
+    """
+    invalid = invalid_email_addresses(emails)
+    if invalid:
+        raise ValueError("Not valid e-mail addresses: %s" % ", ".join(
+            repr(email) for index, email in invalid))
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def set_transport(transport):
+    """
+    Set the transport sendmail() uses by default. A transport has a
+    deliver(envelope_from, recipients, message) method.
+    """
+    global _transport
+
+    with _transport_lock:
+        old, _transport = _transport, transport
+
+    if old is not None and old is not transport:
+        old.close()
+
+def get_transport():
+    """
+    Return the default transport, creating it on first use.
+    """
+    global _transport
+
+    with _transport_lock:
+        if _transport is None:
+            import socket
+            hostname = socket.gethostname()
+            for prefix, relay in smtp_relays.items():
+                if hostname.startswith(prefix):
+                    _transport = smtp_transport(relay)
+                    break
+            else:
+                _transport = sendmail_binary_transport()
+
+        return _transport
+
+_observer = None
+
+def set_mail_observer(observer):
+    """
+    Call `observer` with a mail_event for each message sendmail(),
+    async_sendmail(), sendmail_merge() or a t4.mailspool worker hands to
+    a transport, after delivery succeeded or failed. None (the default)
+    turns observation off, so it costs nothing. t4.mailmetrics has
+    observers that export to StatsD or a Prometheus text file.
+
+    The observer is called in the thread (or task) that sent the
+    message. Exceptions it raises are logged and otherwise ignored.
+    """
+    global _observer
+    _observer = observer
+
+def get_mail_observer():
+    return _observer
+
+class mail_event:
+    """
+    What the mail observer learns about a message:
+
+    function    "sendmail", "async_sendmail", "sendmail_merge" or
+                "mail_spool"
+    transport   The transport’s class name.
+    recipients  The number of envelope recipients.
+    size        The length of the message as delivered, in characters
+                (which is its size in bytes, unless it contains 8-bit
+                headers).
+    timings     Seconds spent in each stage: "compose" (building the
+                message, next to nothing for the spool), "encode"
+                (as_string() and encoding attachments, or reading the
+                spool file, which happens while the transport writes
+                the message) and "deliver" (the rest of the transport’s
+                time: starting sendmail or talking to the SMTP server).
+    error       The exception delivery failed with, or None.
+    """
+    def __init__(self, function, recipients):
+        self.function = function
+        self.transport = None
+        self.recipients = recipients
+        self.size = 0
+        self.timings = {}
+        self.error = None
+
+        self._start = time.perf_counter()
+        self._message = None
+
+    def delivering(self, message, transport):
+        """
+        Note the end of the compose stage and return `message` wrapped
+        so the encode stage and the size are measured as the
+        `transport` reads it.
+        """
+        now = time.perf_counter()
+        self.timings["compose"] = now - self._start
+        self._start = now
+
+        self.transport = type(transport).__name__
+        self._message = _timed_message(message)
+        return self._message
+
+    def finish(self):
+        elapsed = time.perf_counter() - self._start
+        if self._message is None:
+            self.timings["compose"] = elapsed
+        else:
+            self.size = self._message.size
+            self.timings["encode"] = self._message.encode_time
+            self.timings["deliver"] = elapsed - self._message.encode_time
+
+class _timed_message:
+    """
+    Iterate over a message, adding up the time it takes to produce its
+    pieces and their length. Both are reset when it is iterated over
+    again, as transports do when they retry.
+    """
+    def __init__(self, message):
+        self.message = message
+        self.encode_time = 0.0
+        self.size = 0
+
+    @property
+    def repeatable(self):
+        return _repeatable(self.message)
+
+    def __iter__(self):
+        self.encode_time = 0.0
+        self.size = 0
+
+        if isinstance(self.message, str):
+            self.size = len(self.message)
+            yield self.message
+            return
+
+        pieces = iter(self.message)
+        while True:
+            start = time.perf_counter()
+            piece = next(pieces, None)
+            self.encode_time += time.perf_counter() - start
+            if piece is None:
+                break
+            self.size += len(piece)
+            yield piece
+
+_unobserved = nullcontext()
+
+def _observation(function, recipients):
+    """
+    Return a context manager that yields a mail_event to fill in and
+    passes it to the observer afterwards, or one that yields None if
+    there is no observer.
+    """
+    if _observer is None:
+        return _unobserved
+    else:
+        return _observed(_observer, function, recipients)
+
+@contextmanager
+def _observed(observer, function, recipients):
+    event = mail_event(function, recipients)
+    try:
+        yield event
+    except BaseException as exc:
+        event.error = exc
+        raise
+    finally:
+        event.finish()
+        try:
+            observer(event)
+        except Exception:
+            # Don’t make a delivered message look like it failed.
+            import logging
+            logging.getLogger(__name__).exception("Mail observer failed")
+
 def sendmail(from_name, from_email,
              to_name, to_email,
              subject, message, attachments=[], headers={}, bcc=[],             
-             text_subtype="plain", encoding="utf-8", multipart_subtype="mixed"):
-    # Verify all the e-Mail Addresses
-    def verify_email_address(email):
-        if email_re.match(email) is None:
-            raise ValueError("Not a valid e-mail address: %s" % repr(email))
+             text_subtype="plain", encoding="utf-8", multipart_subtype="mixed",
+             transport=None):
+    """
+    Compose a message and deliver it to `to_email` and the `bcc`
+    addresses in a single envelope, using `transport` or, by default,
+    get_transport().
+    """
+    with _observation("sendmail", 1 + len(bcc)) as event:
+        composed = compose(from_name, from_email, to_name, to_email,
+                           subject, message, attachments, headers, bcc,
+                           text_subtype, encoding, multipart_subtype)
+
+        if transport is None:
+            transport = get_transport()
+
+        if event is not None:
+            composed = event.delivering(composed, transport)
+
+        transport.deliver(from_email, [ to_email, ] + list(bcc), composed)
+
+def compose(from_name, from_email,
+            to_name, to_email,
+            subject, message, attachments=[], headers={}, bcc=[],
+            text_subtype="plain", encoding="utf-8", multipart_subtype="mixed"):
+    """
+    Verify the addresses and return the message sendmail() would send as
+    a composed_message.
+    """
+    import uuid
+
+    _load_email()
 
-    map(verify_email_address, bcc)
+    # Verify all the e-Mail Addresses
+    verify_email_addresses(bcc)
     verify_email_address(from_email)
     verify_email_address(to_email)
         
+    # Only an ll.xist node if ll.xist has been imported.
+    xsc = sys.modules.get("ll.xist.xsc")
     if xsc is not None and isinstance(message, xsc.Node):
         message = message.string(encoding=encoding)
         if text_subtype == "plain":
@@ -137,25 +930,485 @@ def sendmail(from_name, from_email,
     if not outer.preamble:
         outer.preamble = "You will not see this in a MIME-aware mail reader.\n"
 
+    streams = {}
     for a in attachments:
         assert isinstance(a, sendmail_attachment), TypeError
-        outer.attach(a.part())
+        if a.streamed:
+            token = "t4-attachment-" + uuid.uuid4().hex
+            streams[token] = a
+            outer.attach(a.placeholder_part(token))
+        else:
+            outer.attach(a.part())
 
-    composed = outer.as_string()
+    return composed_message(outer, streams)
 
-    if socket.gethostname().startswith("leela."):
-        s = smtplib.SMTP("hermes.tux4web.de")
-        s.sendmail(from_email, to_email, composed)
-        for email in bcc: s.sendmail(from_email, email, composed)
-        s.quit()
-    else:
-        state = subprocess.run(
-            ["/usr/sbin/sendmail",
-             "-f", from_email, # Set the envelope sender.
-             to_email] + bcc,
-            input=composed,
-            capture_output=True,
-            encoding="utf-8")
+def sendmail_merge(from_name, from_email, subject, message, recipients,
+                   attachments=[], headers={},
+                   text_subtype="plain", encoding="utf-8",
+                   multipart_subtype="mixed", transport=None):
+    """
+    Send the same message to many recipients, one envelope each.
+    `recipients` is an iterable of ( to_name, to_email, substitutions, )
+    tuples. `subject` and `message` are string.Template strings; each
+    recipient’s `substitutions` dict, plus $to_name and $to_email, is
+    filled in with safe_substitute().
 
-        if state.returncode != 0: raise IOError(state.stderr)
-    
+    The message is composed and its attachments are encoded only once.
+    For each recipient only the To: and Subject: headers and the text
+    part are rendered and spliced in. Returns a list of
+    ( to_email, exception, ) tuples for the recipients that failed.
+    """
+    import uuid
+
+    verify_email_address(from_email)
+
+    if transport is None:
+        transport = get_transport()
+
+    token = uuid.uuid4().hex
+    to_token = "t4-merge-to-" + token
+    subject_token = "t4-merge-subject-" + token
+    body_token = "t4-merge-body-" + token
+
+    composed = compose(from_name, from_email, "", "merge@example.com",
+                       subject_token, body_token, attachments, headers, [],
+                       text_subtype, encoding, multipart_subtype)
+    composed.message.replace_header("To", to_token)
+    composed.message.replace_header("Subject", subject_token)
+
+    pieces = re.split("(%s|%s|%s)" % ( to_token, subject_token, body_token, ),
+                      composed.as_string())
+
+    subject = string.Template(subject)
+    message = string.Template(message)
+    # Message.as_string() does not fold headers.
+    policy = composed.message.policy.clone(max_line_length=0)
+
+    def header_value(name, value):
+        return policy.fold(name, value)[len(name)+2:].rstrip("\n")
+
+    last_body, last_payload = None, None
+
+    failed = []
+    for to_name, to_email, substitutions in recipients:
+        try:
+            with _observation("sendmail_merge", 1) as event:
+                verify_email_address(to_email)
+
+                substitutions = dict(substitutions,
+                                     to_name=to_name, to_email=to_email)
+
+                body = message.safe_substitute(substitutions)
+                if body != last_body:
+                    last_body = body
+                    last_payload = MIMEText(body, text_subtype,
+                                            encoding).get_payload()
+
+                values = {
+                    to_token: header_value("To", formataddr( (to_name,
+                                                              to_email,) )),
+                    subject_token: header_value(
+                        "Subject",
+                        Header(subject.safe_substitute(substitutions))),
+                    body_token: last_payload, }
+
+                rendered = [ values.get(piece, piece) for piece in pieces ]
+                if event is not None:
+                    rendered = event.delivering(rendered, transport)
+
+                transport.deliver(from_email, [ to_email, ], rendered)
+        except Exception as exc:
+            failed.append( (to_email, exc,) )
+
+    return failed
+
+class async_sendmail_binary_transport:
+    """
+    The asyncio counterpart to sendmail_binary_transport: Pipes messages
+    into the sendmail binary without blocking the event loop. Runs no
+    more than `max_processes` at a time and kills a process that has not
+    finished after `timeout` seconds, along with the processes it
+    started.
+    """
+    def __init__(self, path="/usr/sbin/sendmail", max_processes=8,
+                 timeout=60):
+        self.path = path
+        self.max_processes = max_processes
+        self.timeout = timeout
+        self._slots = None
+
+    async def deliver(self, envelope_from, recipients, message):
+        import asyncio
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_processes)
+
+        if isinstance(message, str):
+            message = [ message, ]
+
+        async with self._slots:
+            process = await asyncio.create_subprocess_exec(
+                self.path, "-f", envelope_from, *recipients,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True)
+
+            async def communicate():
+                try:
+                    async for chunk in _in_executor(message):
+                        process.stdin.write(chunk.encode("utf-8"))
+                        await process.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass # The exit status will tell us what went wrong.
+                # communicate() closes stdin only if it is given input.
+                process.stdin.close()
+                return await process.communicate()
+
+            try:
+                stdout, stderr = await asyncio.wait_for(communicate(),
+                                                        self.timeout)
+            except:
+                if process.returncode is None:
+                    # Kill the processes sendmail started, too: wait()
+                    # only returns once nobody holds the pipes open.
+                    import signal
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    await process.wait()
+                raise
+
+        if process.returncode != 0:
+            raise IOError(stderr.decode("utf-8", "replace"))
+
+    async def close(self):
+        pass
+
+class async_smtp_transport:
+    """
+    The asyncio counterpart to smtp_transport, with a minimal SMTP client
+    built on asyncio streams. Up to `pool_size` connections are open at a
+    time, which also limits the number of concurrent deliveries. Waiting
+    for the server for more than `timeout` seconds raises
+    asyncio.TimeoutError. Failures raise the same smtplib exceptions
+    smtp_transport does.
+    """
+    def __init__(self, host, port=25, username=None, password=None,
+                 starttls=False, ssl=False, pool_size=4, keepalive=60,
+                 timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.ssl = ssl
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.timeout = timeout
+
+        self._idle = [] # ( connection, last used, ) tuples.
+        self._slots = None
+
+    async def _connect(self):
+        import asyncio, ssl, smtplib, socket
+
+        context = None
+        if self.ssl or self.starttls:
+            context = ssl.create_default_context()
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            self.host, self.port, ssl=context if self.ssl else None),
+                                                self.timeout)
+        connection = _async_smtp_connection(reader, writer, self.timeout)
+        try:
+            code, response = await connection.reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, response)
+
+            await connection.ehlo(socket.gethostname())
+
+            if self.starttls:
+                code, response = await connection.command("STARTTLS")
+                if code != 220:
+                    raise smtplib.SMTPNotSupportedError(
+                        "STARTTLS failed: %i %s" % ( code, response, ))
+                await asyncio.wait_for(
+                    writer.start_tls(context, server_hostname=self.host),
+                    self.timeout)
+                await connection.ehlo(socket.gethostname())
+
+            if self.username is not None:
+                credentials = base64.b64encode(("\0%s\0%s" % (
+                    self.username, self.password, )).encode("utf-8"))
+                code, response = await connection.command(
+                    "AUTH PLAIN " + credentials.decode("ascii"))
+                if code != 235:
+                    raise smtplib.SMTPAuthenticationError(code, response)
+        except:
+            connection.close()
+            raise
+
+        return connection
+
+    async def _checkout(self):
+        import asyncio, smtplib
+
+        while self._idle:
+            connection, last_used = self._idle.pop()
+            if time.monotonic() - last_used < self.keepalive:
+                return connection
+
+            try:
+                code, response = await connection.command("NOOP")
+            except (smtplib.SMTPException, OSError, asyncio.TimeoutError):
+                code = None
+            if code == 250:
+                return connection
+            connection.close()
+
+        return await self._connect()
+
+    async def deliver(self, envelope_from, recipients, message):
+        """
+        `message` is a str or an iterable of str pieces, like a
+        composed_message. The message is re-tried once on a dropped
+        connection if it can be iterated over again.
+        """
+        import asyncio, smtplib
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool_size)
+
+        recipients = list(recipients)
+        retry = _repeatable(message)
+        if isinstance(message, str):
+            message = [ message, ]
+
+        for attempt in range(2):
+            async with self._slots:
+                connection = await self._checkout()
+                try:
+                    refused = await connection.sendmail(envelope_from,
+                                                        recipients, message)
+                except (smtplib.SMTPRecipientsRefused,
+                        smtplib.SMTPResponseException):
+                    # The server said no, but the connection is fine.
+                    self._idle.append( (connection, time.monotonic(),) )
+                    raise
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    connection.close()
+                    if attempt > 0 or not retry: raise
+                    continue
+                except:
+                    connection.close()
+                    raise
+                else:
+                    self._idle.append( (connection, time.monotonic(),) )
+                    break
+
+        if refused:
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+    async def close(self):
+        """
+        Close all idle connections.
+        """
+        idle, self._idle = self._idle, []
+        for connection, last_used in idle:
+            await connection.quit()
+
+class _async_smtp_connection:
+    def __init__(self, reader, writer, timeout):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+
+    async def reply(self):
+        """
+        Read a (possibly multi-line) reply and return its code and text.
+        """
+        import asyncio, smtplib
+
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(),
+                                          self.timeout)
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected(
+                    "Connection unexpectedly closed")
+            try:
+                code = int(line[:3])
+            except ValueError:
+                raise smtplib.SMTPResponseException(
+                    -1, b"Invalid response: " + line)
+            lines.append(line[4:].strip())
+            if line[3:4] != b"-":
+                return code, b"\n".join(lines)
+
+    async def command(self, line):
+        self.writer.write(line.encode("utf-8") + b"\r\n")
+        await self.drain()
+        return await self.reply()
+
+    async def drain(self):
+        import asyncio
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def ehlo(self, hostname):
+        import smtplib
+
+        code, response = await self.command("EHLO " + hostname)
+        if code != 250:
+            code, response = await self.command("HELO " + hostname)
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, response)
+
+    async def rset(self):
+        import smtplib
+
+        try:
+            await self.command("RSET")
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            pass
+
+    async def sendmail(self, envelope_from, recipients, chunks):
+        """
+        What _smtp_sendmail_chunks() does for an smtplib connection.
+        """
+        import smtplib
+
+        code, response = await self.command("MAIL FROM:<%s>" % envelope_from)
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                await self.rset()
+            raise smtplib.SMTPSenderRefused(code, response, envelope_from)
+
+        refused = {}
+        for recipient in recipients:
+            code, response = await self.command("RCPT TO:<%s>" % recipient)
+            if code not in ( 250, 251, ):
+                refused[recipient] = ( code, response, )
+            if code == 421:
+                # See _smtp_sendmail_chunks().
+                self.close()
+                raise _disconnected(code, response)
+
+        if len(refused) == len(recipients):
+            await self.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, response = await self.command("DATA")
+        if code != 354:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, response)
+
+        async for data in _in_executor(_smtp_data(chunks)):
+            self.writer.write(data)
+            await self.drain()
+
+        code, response = await self.reply()
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, response)
+
+        return refused
+
+    async def quit(self):
+        try:
+            await self.command("QUIT")
+        except Exception:
+            pass
+        self.close()
+
+    def close(self):
+        self.writer.close()
+
+async def _in_executor(iterable):
+    """
+    Iterate over `iterable` in the event loop’s default executor, so
+    that encoding attachments and reading them from disk don’t block
+    the loop. Lists and strs are iterated over right away.
+    """
+    import asyncio
+
+    if isinstance(iterable, (str, list, tuple,)):
+        for item in iterable:
+            yield item
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, None)
+        if item is None:
+            break
+        yield item
+
+_async_transport = None
+
+def set_async_transport(transport):
+    """
+    Set the transport async_sendmail() uses by default. An async
+    transport has a coroutine method deliver(envelope_from, recipients,
+    message).
+    """
+    global _async_transport
+    _async_transport = transport
+
+def get_async_transport():
+    """
+    Return the default async transport, creating it on first use like
+    get_transport() does.
+    """
+    global _async_transport
+
+    if _async_transport is None:
+        import socket
+
+        hostname = socket.gethostname()
+        for prefix, relay in smtp_relays.items():
+            if hostname.startswith(prefix):
+                _async_transport = async_smtp_transport(relay)
+                break
+        else:
+            _async_transport = async_sendmail_binary_transport()
+
+    return _async_transport
+
+async def async_sendmail(from_name, from_email,
+                         to_name, to_email,
+                         subject, message, attachments=[], headers={}, bcc=[],
+                         text_subtype="plain", encoding="utf-8",
+                         multipart_subtype="mixed", transport=None):
+    """
+    sendmail() for asyncio code. The message is composed by compose(),
+    just like sendmail()’s, and delivered using `transport` or, by
+    default, get_async_transport(). Attachments are read and encoded in
+    the event loop’s default executor.
+    """
+    import asyncio
+
+    arguments = ( from_name, from_email, to_name, to_email,
+                  subject, message, attachments, headers, bcc,
+                  text_subtype, encoding, multipart_subtype, )
+
+    with _observation("async_sendmail", 1 + len(bcc)) as event:
+        if attachments:
+            composed = await asyncio.get_running_loop().run_in_executor(
+                None, compose, *arguments)
+        else:
+            composed = compose(*arguments)
+
+        if transport is None:
+            transport = get_async_transport()
+
+        if event is not None:
+            composed = event.delivering(composed, transport)
+
+        await transport.deliver(from_email, [ to_email, ] + list(bcc),
+                                composed)
@@ -27,6 +27,43 @@
 
 import sys, re, unicodedata, os.path as op
 
+def _asciify_char(char):
+    """
+    Return the ASCIIfied replacement for a single character: The first
+    code point of its decomposition, the super-scripted character for
+    <super> decompositions, the empty string for other compatibility
+    decompositions and the character itself if it does not decompose.
+    """
+    decomp = unicodedata.decomposition(char)
+    if decomp: # Not an empty string
+        d = decomp.split()[0]
+        try:
+            return chr(int(d, 16))
+        except ValueError:
+            if d == "<super>":
+                return chr(int(decomp.split()[1], 16))
+            else:
+                return ""
+                #raise Exception("Can't handle this: " + repr(decomp))
+    else:
+        return char
+
+class _translation_table(dict):
+    """
+    A str.translate() table that computes its entries on first lookup
+    and remembers them, so each code point is decomposed only once per
+    process.
+    """
+    def __init__(self, function):
+        self.function = function
+
+    def __missing__(self, codepoint):
+        ret = self.function(chr(codepoint))
+        self[codepoint] = ret
+        return ret
+
+_asciify_table = _translation_table(_asciify_char)
+
 def asciify(string):
     '''
     "ASCIIfy" a Unicode string by stripping all umlauts, tildes, etc.
@@ -41,30 +78,13 @@ def asciify(string):
     # To work reliably the way it is, strings must consist of composed
     # characters.
     string = unicodedata.normalize("NFC", string)
-
-    temp = u''
-    for char in string:
-        decomp = unicodedata.decomposition(char)
-        if decomp: # Not an empty string
-            d = decomp.split()[0]
-            try:
-                temp += chr(int(d, 16))
-            except ValueError:
-                if d == "<super>":
-                    temp += chr(int(decomp.split()[1], 16))
-                else:
-                    pass
-                    #raise Exception("Can't handle this: " + repr(decomp))
-        else:
-            temp += char
-
-    return temp
+    return string.translate(_asciify_table)
 
 
-default_reserved_ids = ("image_slots edit set get download id fields "
-                        "downloads image images fields slotinfo store "
-                        "get_image has_image tag image_tag search translator"
-                        ).split(" ")
+default_reserved_ids = frozenset(
+    ("image_slots edit set get download id fields "
+     "downloads image images fields slotinfo store "
+     "get_image has_image tag image_tag search translator").split(" "))
 
 # Yeah, this is revered beta code, sort of.
 greek_letters = {
@@ -96,6 +116,28 @@ greek_letters = {
 }
 
 
+def _id_char(char):
+    """
+    Return what title_to_id() makes of a single (composed) character:
+    One or more id characters or a space for anything that separates
+    parts of the id.
+    """
+    # Eigentlich nur für’s ELKG.
+    char = _asciify_char(char).replace("¹", "1").replace("²", "2")
+
+    ret = []
+    for c in char:
+        if c in "abcdefghijklmnopqrstuvwxyz0123456789":
+            ret.append(c)
+        elif c in greek_letters:
+            ret.append(greek_letters[c])
+        else:
+            ret.append(" ")
+
+    return "".join(ret)
+
+_id_table = _translation_table(_id_char)
+
 def title_to_id(title, all_lowercase=True, reserved_ids=default_reserved_ids,
                 separator="_"):
     """
@@ -105,35 +147,73 @@ def title_to_id(title, all_lowercase=True, reserved_ids=default_reserved_ids,
 
     if all_lowercase: title = title.lower()
     title = title.replace("ß", "ss")
-    title = asciify(title)
-
-    # Eigentlich nur für’s ELKG.
-    title = title.replace("¹", "1")
-    title = title.replace("²", "2")
-
-    parts = [""]
-    for char in title:
-        if char in "abcdefghijklmnopqrstuvwxyz0123456789":
-            parts[-1] += char
-        elif char in greek_letters:
-            parts[-1] += greek_letters[char]
-        else:
-            if len(parts[-1]) > 0:
-                parts.append("")
+    title = unicodedata.normalize("NFC", title)
 
-    if parts[-1] == "":
-        parts = parts[:-1]
+    # One pass does the asciify() step, the ¹/² replacements, the Greek
+    # letters and maps everything else to whitespace, which split()
+    # below turns into separators.
+    parts = title.translate(_id_table).split()
 
     id = separator.join(parts)
-    id = id.encode("ascii", "ignore")
-
-    if all_lowercase:
-        id = id.lower()
 
     if id in reserved_ids:
         id = id.capitalize()
 
-    return id.decode("ascii")
+    return id
+
+class id_allocator:
+    """
+    Hand out unique ids for a stream of titles. The allocator keeps a
+    hashed set of the ids in use and, for each base id, the next numeric
+    suffix to try, so a title that collides gets “foo_2”, “foo_3”, …
+    without re-checking the suffixes already handed out.
+
+    `taken` is an iterable of ids that already exist (in the database,
+    say). The other keyword arguments are passed on to title_to_id().
+    """
+    def __init__(self, taken=(), all_lowercase=True,
+                 reserved_ids=default_reserved_ids, separator="_"):
+        self.taken = set(taken)
+        self.all_lowercase = all_lowercase
+        self.reserved_ids = frozenset(reserved_ids)
+        self.separator = separator
+        self._next_suffix = {}
+
+    def allocate(self, title):
+        """
+        Return a unique id for `title` and mark it as taken.
+        """
+        id = title_to_id(title, self.all_lowercase,
+                         self.reserved_ids, self.separator)
+
+        if id in self.taken:
+            counter = self._next_suffix.get(id, 2)
+            while True:
+                candidate = "%s%s%i" % ( id, self.separator, counter, )
+                counter += 1
+                if candidate not in self.taken:
+                    break
+            self._next_suffix[id] = counter
+            id = candidate
+
+        self.taken.add(id)
+        return id
+
+    __call__ = allocate
+
+    def allocate_all(self, titles):
+        """
+        Yield a unique id for each of the `titles` in order.
+        """
+        for title in titles:
+            yield self.allocate(title)
+
+def unique_ids(titles, taken=(), **kw):
+    """
+    Yield unique ids for an iterable of titles, avoiding those in `taken`.
+    See id_allocator.
+    """
+    return id_allocator(taken, **kw).allocate_all(titles)
 
 
 
@@ -147,17 +227,59 @@ illegel_in_filename_re = re.compile(
     r"^\.|(\s*\.+\s+|/|\\|\.{2,}|:|!|#| |\"|'|\s)+")
 
 def safe_filename(name, contains_dir=False, unicode_normalize_to="NFD"):
+    """
+    Make `name` safe to use as a file name: No path separators, no
+    leading dots and no runs of whitespace or punctuation that might
+    trip up a shell. If `contains_dir` is true, only the last component
+    of a path is used.
+    """
     if contains_dir:
-        parts = path_sep_re.split(name)
-        fn = parts[-1]
-    else:
-        fn = name
+        name = path_sep_re.split(name)[-1]
 
     ret = illegel_in_filename_re.sub(" ", name).strip()
 
     # The regular expression does not catch all cases in which someone
     # might try to inject a hidden file (starting with a .).
-    while ret[0] == ".":
-        ret = ret[1:]
+    ret = ret.lstrip(".")
 
     return unicodedata.normalize(unicode_normalize_to, ret)
+
+def safe_filenames(names, existing=(), contains_dir=False,
+                   unicode_normalize_to="NFD", case_sensitive=True,
+                   empty_name="unnamed"):
+    """
+    Yield a safe and unique file name for each of the `names`, e.g. the
+    entries of an uploaded archive, without colliding with the names in
+    `existing` (a directory listing, say) or with each other. A name that
+    is taken gets a counter before its extension: “a.pdf”, “a_2.pdf”, …
+    Set `case_sensitive` to False for case-insensitive file systems.
+    """
+    if case_sensitive:
+        key = lambda fn: fn
+    else:
+        key = str.casefold
+
+    taken = { key(unicodedata.normalize(unicode_normalize_to, fn))
+              for fn in existing }
+    next_counter = {}
+
+    for name in names:
+        fn = safe_filename(name, contains_dir, unicode_normalize_to)
+        if not fn:
+            fn = empty_name
+
+        k = key(fn)
+        if k in taken:
+            stem, ext = op.splitext(fn)
+            counter = next_counter.get(k, 2)
+            while True:
+                candidate = "%s_%i%s" % ( stem, counter, ext, )
+                counter += 1
+                if key(candidate) not in taken:
+                    break
+            next_counter[k] = counter
+            fn = candidate
+            k = key(fn)
+
+        taken.add(k)
+        yield fn
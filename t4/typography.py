@@ -1,6 +1,11 @@
-import datetime, re, html, decimal
+import datetime, re, html, decimal, collections
 
-from .sql import normalize_whitespace
+def normalize_whitespace(s):
+    """
+    Replace each run of whitespace with a single space and strip the
+    ends, like sqlclasses.sql.normalize_whitespace().
+    """
+    return " ".join(s.split())
 
 opening_quote_re = re.compile(r'(\s+|^)"([0-9a-zA-Z])')
 closing_quote_re = re.compile(r'(\S+)"(\s+|$|[,\.;!])')
@@ -8,37 +13,284 @@ opening_single_quote_re = re.compile(r"(\s+|^)'([0-9a-zA-Z])")
 closing_single_quote_re = re.compile(r"([^\s']+)'(\s+|$|[,\.;!])")
 date_until_re = re.compile(r'(\d+)\.-(\d+)\.')
 
-def improve_typography(content, lang="de"):
-    if lang == "de":
-        # "gerade" und ,,typografische'' Anführungszeichen
-        content = re.sub(opening_quote_re, u"\\1„\\2", content)
-        content = re.sub(closing_quote_re, u"\\1“\\2", content)
-        content = re.sub(opening_single_quote_re, u"\\1‚\\2", content)
-        content = re.sub(closing_single_quote_re, u"\\1‘\\2", content)
-    elif lang == "en":
-        content = re.sub(opening_quote_re, u"\\1“\\2", content)
-        content = re.sub(closing_quote_re, u"\\1”\\2", content)
-        content = re.sub(opening_single_quote_re, u"\\1‘\\2", content)
-        content = re.sub(closing_single_quote_re, u"\\1’\\2", content)
-    elif lang == "fr":
-        content = re.sub(opening_quote_re, u"\\1«\\2", content)
-        content = re.sub(closing_quote_re, u"\\1»\\2", content)
-        content = re.sub(opening_single_quote_re, u"\\1‹\\2", content)
-        content = re.sub(closing_single_quote_re, u"\\1›\\2", content)
-    else:
-        pass
+# Opening and closing double and single quotes by language.
+typography_quotes = { "de": ( "„", "“", "‚", "‘", ),
+                      "en": ( "“", "”", "‘", "’", ),
+                      "fr": ( "«", "»", "‹", "›", ), }
+
+class typography_engine:
+    """
+    All of improve_typography()’s rules compiled into a single regular
+    expression, so the content is scanned once and written to one output
+    buffer. The alternatives reproduce the sequential re.sub()/replace()
+    calls exactly: Those rules that depended on what an earlier match had
+    consumed keep a little state in the replacement callback.
+    """
+    terminator = r"(?=[\s,.;!]|$)"
+
+    def __init__(self, quotes=None):
+        self.quotes = quotes
+
+        # Every alternative starts with a literal character, which lets
+        # the regex engine skip ahead to candidate positions quickly, and
+        # ends in an empty group that names the rule for the callback.
+        rules = []
+        if quotes is not None:
+            rules += [
+                # "gerade" und ,,typografische'' Anführungszeichen
+                r'"(?<!\S")(?=[0-9a-zA-Z])(?P<open_dq>)',
+                # Only the last closing quote in a run of non-whitespace,
+                # like the greedy (\S+) in closing_quote_re.
+                r'"(?<=\S")%s(?!\S*"%s)(?P<close_dq>)' % ( self.terminator,
+                                                          self.terminator, ),
+                r"'(?<!\S')(?=[0-9a-zA-Z])(?P<open_sq>)",
+                r"'(?<=[^\s']')%s(?P<close_sq>)" % self.terminator, ]
+        rules += [
+            # Converts 1.-2. into 1.–2. (with a proper 'until' dash)
+            r"\.-(?<=\d\.-)(?=(?P<date_tail>\d+)\.)(?P<date>)",
+            # Put long dashes where they (might) belog. The space after
+            # the dash still precedes an ellipsis.
+            r" - \.\.\.(?P<dash_ellipsis>)",
+            r" - (?P<dash>)",
+            # Ellipsis, with a non-breaking space before it.
+            r" \.\.\.(?P<space_ellipsis>)",
+            r"\.\.\.(?P<ellipsis>)", ]
+
+        self.regex = re.compile("|".join(rules))
+
+        self.replacements = { "dash_ellipsis": " —\u00a0…",
+                              "dash": " — ",
+                              "space_ellipsis": "\u00a0…",
+                              "ellipsis": "…", }
+        if quotes is not None:
+            ( self.replacements["open_dq"], self.replacements["close_dq"],
+              self.replacements["open_sq"], self.replacements["close_sq"],
+             ) = quotes
+
+    def replacer(self):
+        """
+        Return a fresh re.sub() callback for one piece of content.
+        """
+        replacements = self.replacements
+        close_sq = replacements.get("close_sq")
+
+        # Index of the first character not consumed by the last
+        # closing_single_quote_re and date_until_re match, respectively.
+        consumed = [ 0, 0, ]
+
+        def replace(match):
+            kind = match.lastgroup
+            if kind == "close_sq":
+                start = match.start()
+                if start - 1 < consumed[0]:
+                    return "'"
+                consumed[0] = start + 2
+                return close_sq
+            elif kind == "date":
+                start = match.start()
+                if start - 1 < consumed[1]:
+                    return ".-"
+                consumed[1] = match.end() + len(match.group("date_tail")) + 1
+                return ".–"
+            else:
+                return replacements[kind]
 
-    # Converts 1.-2. into 1.–2. (with a proper 'until' dash)
-    content = re.sub(date_until_re, r"\1.–\2.", content)
+        return replace
 
-    # Put long dashes where they (might) belog
-    content = content.replace(u" - ", u" — ")
+    def __call__(self, content):
+        return self.regex.sub(self.replacer(), content)
 
-    # Ellipsis
-    content = content.replace(" ...", " …")
-    content = content.replace("...", "…")
+_typography_engines = {}
+def get_typography_engine(lang):
+    """
+    Return the (cached) typography_engine for `lang`. Languages without
+    an entry in typography_quotes get dashes, date ranges and ellipses,
+    but no quotes.
+    """
+    engine = _typography_engines.get(lang)
+    if engine is None:
+        engine = typography_engine(typography_quotes.get(lang))
+        _typography_engines[lang] = engine
+    return engine
+
+def register_typography_language(lang, double_quotes, single_quotes):
+    """
+    Add or replace the typographic quotes for `lang`. Both quote
+    arguments are ( opening, closing, ) pairs.
+    """
+    typography_quotes[lang] = tuple(double_quotes) + tuple(single_quotes)
+    _typography_engines.pop(lang, None)
+
+# Set by enable_render_cache().
+_render_cache = None
 
-    return content
+# Part of the render cache keys. Increment it whenever a change to this
+# module changes what improve_typography() or add_web_paragraphs()
+# return, so results cached on disk by an older version are not used.
+render_format = 1
+
+def enable_render_cache(max_size=32*1024*1024, path=None,
+                        disk_max_size=512*1024*1024, min_length=512):
+    """
+    Cache the results of improve_typography() and add_web_paragraphs()
+    in a t4.rendercache.render_cache created with these arguments and
+    return it. Pass a `path` to share results between processes through
+    an SQLite database.
+    """
+    global _render_cache
+
+    from t4.rendercache import render_cache
+    _render_cache = render_cache(max_size, path, disk_max_size, min_length)
+    return _render_cache
+
+def disable_render_cache():
+    global _render_cache
+    _render_cache = None
+
+def improve_typography(content, lang="de"):
+    engine = get_typography_engine(lang)
+    if _render_cache is not None:
+        return _render_cache.render(
+            "improve_typography", ( render_format, lang, engine.quotes, ),
+            content, engine)
+    return engine(content)
+
+# Elements that end one run of text and start another, for
+# iter_improve_typography_html().
+html_block_elements = {
+    "address", "article", "aside", "blockquote", "body", "caption", "dd",
+    "details", "dialog", "div", "dl", "dt", "fieldset", "figcaption",
+    "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "head",
+    "header", "hgroup", "hr", "html", "legend", "li", "main", "menu", "nav",
+    "ol", "option", "p", "pre", "section", "summary", "table", "tbody",
+    "td", "tfoot", "th", "thead", "title", "tr", "ul", }
+
+# Elements whose contents are left alone.
+html_verbatim_elements = { "code", "kbd", "pre", "samp", "script", "style",
+                           "textarea", "tt", }
+
+def iter_improve_typography_html(chunks, lang="de"):
+    """
+    improve_typography() for HTML given as an iterable of str `chunks`,
+    yielding the result in pieces. Only text is changed, never markup,
+    and neither the contents of the html_verbatim_elements.
+
+    The text between two block element tags is treated as a unit, as if
+    the inline tags in it were not there, so quotes are matched up
+    across <em>s and <a>s. Verbatim elements count as a word, <br> as a
+    line break. Output is held back only up to the end of the current
+    block. Inline verbatim elements end with the block they are in,
+    whether they are closed or not.
+    """
+    from t4.web import html_tokens
+
+    engine = get_typography_engine(lang)
+
+    out = [] # Output for the current block.
+    text = [] # Its text, with placeholders.
+    slots = [] # ( index in out, start in text, end in text, )
+    length = 0
+    verbatim = 0 # Number of open inline verbatim elements.
+    pre = 0 # Number of open block verbatim elements.
+
+    def flush():
+        nonlocal length
+
+        if slots:
+            _apply_typography(engine, "".join(text), out, slots)
+
+        ret = "".join(out)
+        del out[:], text[:], slots[:]
+        length = 0
+        return ret
+
+    for kind, token, name in html_tokens(chunks, ( "script", "style",
+                                                   "textarea", )):
+        # <code/> and the like contain nothing.
+        opens = kind == "start" and not token.endswith("/>")
+
+        if name in html_block_elements:
+            output = flush()
+            if output:
+                yield output
+            yield token
+
+            verbatim = 0
+            if name in html_verbatim_elements: # <pre>
+                if opens:
+                    pre += 1
+                elif kind == "end" and pre:
+                    pre -= 1
+            continue
+
+        if kind == "text":
+            if not verbatim and not pre:
+                slots.append( ( len(out), length, length + len(token), ) )
+                text.append(token)
+                length += len(token)
+        elif name in html_verbatim_elements:
+            if opens:
+                verbatim += 1
+                if verbatim == 1:
+                    text.append("x")
+                    length += 1
+            elif kind == "end" and verbatim:
+                verbatim -= 1
+        elif name == "br":
+            text.append("\n")
+            length += 1
+
+        out.append(token)
+
+    output = flush()
+    if output:
+        yield output
+
+def _apply_typography(engine, text, out, slots):
+    """
+    Run `engine` on `text` and carry out its replacements on the pieces
+    of text in `out` the `slots` point to. A replacement that spans
+    several pieces goes into the first one.
+    """
+    replace = engine.replacer()
+
+    # ( index in slots, start, end, replacement, ) relative to the slot.
+    edits = collections.defaultdict(list)
+    slot = 0
+    for match in engine.regex.finditer(text):
+        replacement = replace(match)
+        start, end = match.span()
+        if replacement == match.group():
+            continue
+
+        while slots[slot][2] <= start:
+            slot += 1
+
+        s = slot
+        while True:
+            index, slot_start, slot_end = slots[s]
+            edits[s].append( ( max(start, slot_start) - slot_start,
+                               min(end, slot_end) - slot_start,
+                               replacement, ) )
+            replacement = ""
+            if end <= slot_end:
+                break
+            s += 1
+
+    for s, slot_edits in edits.items():
+        index, slot_start, slot_end = slots[s]
+        piece = out[index]
+        parts = []
+        pos = 0
+        for start, end, replacement in slot_edits:
+            parts.append(piece[pos:start])
+            parts.append(replacement)
+            pos = end
+        parts.append(piece[pos:])
+        out[index] = "".join(parts)
+
+def improve_typography_html(content, lang="de"):
+    return "".join(iter_improve_typography_html([ content, ], lang))
 
 def add_web_paragraphs(s, use_ps=True):
     """
@@ -48,6 +300,13 @@ def add_web_paragraphs(s, use_ps=True):
     as a single paragraph. The input must not contain html, because it will
     be quoted.
     """
+    if _render_cache is not None:
+        return _render_cache.render("add_web_paragraphs",
+                                    ( render_format, use_ps, ), s,
+                                    lambda s: _add_web_paragraphs(s, use_ps))
+    return _add_web_paragraphs(s, use_ps)
+
+def _add_web_paragraphs(s, use_ps):
     s = html.escape(s)
 
     s = s.replace("\r\n", "\n")
@@ -61,6 +320,48 @@ def add_web_paragraphs(s, use_ps=True):
 
     return "\n\n".join(ps)
 
+def iter_web_paragraphs(source, use_ps=True, chunk_size=64*1024):
+    """
+    Like add_web_paragraphs(), but yield the HTML in pieces as the text
+    is consumed. `source` is a str, a file-like object which is read
+    `chunk_size` characters at a time or an iterable of str chunks.
+    "".join() of the result equals add_web_paragraphs() of the whole text.
+    """
+    if isinstance(source, str):
+        chunks = ( source[a:a+chunk_size]
+                   for a in range(0, len(source), chunk_size) )
+    elif hasattr(source, "read"):
+        chunks = iter(lambda: source.read(chunk_size), "")
+    else:
+        chunks = source
+
+    if use_ps:
+        separator = "</p>\n\n<p>"
+        yield "<p>"
+    else:
+        separator = "\n\n"
+
+    # A run of line breaks is held back until the next chunk, so \r\n
+    # pairs and paragraph breaks are never split between two chunks.
+    rest = ""
+    for chunk in chunks:
+        text = rest + chunk
+        end = len(text.rstrip("\r\n"))
+        rest = text[end:]
+        if end:
+            yield _web_paragraphs(text[:end], separator)
+
+    if rest:
+        yield _web_paragraphs(rest, separator)
+
+    if use_ps:
+        yield "</p>"
+
+def _web_paragraphs(text, separator):
+    text = html.escape(text).replace("\r\n", "\n").replace("\r", "\n")
+    return separator.join([ p.replace("\n", "<br />\n")
+                            for p in text.split("\n\n") ])
+
 def pretty_bytes(bytes):
     if bytes < 1024:
         return str(bytes) + " Bytes"
@@ -73,6 +374,18 @@ def pretty_bytes(bytes):
     else:
         return "%.1f TB" % ( float(bytes) / (1024*1024*1024*1024) )
 
+def pretty_bytes_column(values):
+    """
+    pretty_bytes() for a whole column of values (any iterable, including
+    a NumPy array, which is converted with tolist() first). Return a list
+    of strings. This is no faster than calling pretty_bytes() in a loop:
+    The time goes into formatting each value.
+    """
+    if type(values).__module__ == "numpy":
+        values = values.tolist()
+
+    return [ pretty_bytes(bytes) for bytes in values ]
+
 def parse_duration(s):
     parts = s.split(":")
     parts = list(map(float, parts))
@@ -135,6 +448,102 @@ def parse_german_date(s):
         day, month, year = [ int(n) for n in match.groups() ]
         return datetime.date(year, month, day)
 
+def _numpy_dates(values, unit):
+    if type(values).__module__ == "numpy" and values.dtype.kind == "M":
+        # Datetime64 values convert to ints, not datetime objects, in
+        # units finer than microseconds.
+        return values.astype("datetime64[%s]" % unit).tolist()
+    else:
+        return values
+
+def parse_german_dates(values, datetime64=False, cache_size=65536):
+    """
+    parse_german_date() for a whole column of strings. Each distinct
+    string is parsed only once, up to `cache_size` distinct strings.
+
+    Return a pair ( dates, errors, ). Dates is a list of datetime.date
+    objects, or a datetime64[D] NumPy array if `datetime64` is true, with
+    None (NaT) in place of values that could not be parsed. Errors is a
+    list of ( index, value, exception, ) tuples, one for each of those.
+    """
+    dates = []
+    errors = []
+    cache = {}
+    append = dates.append
+
+    for index, value in enumerate(_numpy_dates(values, "D")):
+        try:
+            date = cache[value]
+        except KeyError:
+            try:
+                date = parse_german_date(value)
+            except (ValueError, TypeError) as exc:
+                date = exc
+            if len(cache) < cache_size:
+                cache[value] = date
+        except TypeError as exc:
+            # Not hashable.
+            date = exc
+
+        if isinstance(date, Exception):
+            errors.append( ( index, value, date, ) )
+            date = None
+
+        append(date)
+
+    if datetime64:
+        # Much faster than having numpy.array() convert the date objects.
+        import numpy
+        epoch = datetime.date(1970, 1, 1).toordinal()
+        nat = numpy.iinfo(numpy.int64).min
+        days = numpy.fromiter(( nat if date is None
+                                else date.toordinal() - epoch
+                                for date in dates ),
+                              dtype=numpy.int64, count=len(dates))
+        dates = days.view("datetime64[D]")
+
+    return dates, errors
+
+def format_german_dates(values, with_time=False, with_timezone=False,
+                        monthname=False, cache_size=65536):
+    """
+    pretty_german_date() for a whole column of dates or datetimes,
+    including a NumPy datetime64 array, in which NaT is formatted like
+    None. Each distinct value is formatted only once, up to `cache_size`
+    distinct values.
+
+    Return a pair ( strings, errors, ). Values that could not be
+    formatted are represented by None in strings and by an
+    ( index, value, exception, ) tuple in errors.
+    """
+    strings = []
+    errors = []
+    cache = {}
+    append = strings.append
+
+    values = _numpy_dates(values, "us" if with_time else "D")
+    for index, value in enumerate(values):
+        try:
+            s = cache[value]
+        except KeyError:
+            try:
+                s = pretty_german_date(value, with_time, with_timezone,
+                                       monthname)
+            except (ValueError, TypeError, AttributeError) as exc:
+                s = exc
+            if len(cache) < cache_size:
+                cache[value] = s
+        except TypeError as exc:
+            s = exc
+
+        if isinstance(s, Exception):
+            errors.append( ( index, value, s, ) )
+            s = None
+
+        append(s)
+
+    return strings, errors
+
 
 def parse_german_float(s):
     """
@@ -148,10 +557,49 @@ def parse_german_float(s):
         # Remove all .s except the last one.
         parts = s.split(".")
         if len(parts) > 2:
-            s = ".".join(parts[:-1]) + "." + parts[-1]
+            s = "".join(parts[:-1]) + "." + parts[-1]
 
     return float(s)
 
+# A . that is followed by another . on the same line.
+_thousands_dot_re = re.compile(r"\.(?=[^.\n]*\.)")
+
+def parse_german_float_column(values):
+    """
+    parse_german_float() for a whole column of values. The strings are
+    joined and transformed as one, so only the float() conversion is left
+    per value. Return a list of floats, or a float64 array if `values` is
+    a NumPy array. Such an array is converted with tolist() and handled
+    like a list; NumPy’s own str to float conversion is slower than
+    float().
+    """
+    is_numpy = type(values).__module__ == "numpy"
+    if is_numpy:
+        values = values.tolist()
+    elif not isinstance(values, (list, tuple,)):
+        values = list(values)
+
+    if set(map(type, values)) <= { str, }:
+        s = "\n".join(values)
+        parts = None
+        if s.count("\n") == len(values) - 1:
+            s = _thousands_dot_re.sub("", s.replace(",", "."))
+            parts = s.split("\n")
+
+        if parts is None:
+            # Newlines inside the values.
+            ret = list(map(parse_german_float, values))
+        else:
+            ret = list(map(float, parts))
+    else:
+        ret = list(map(parse_german_float, values))
+
+    if is_numpy:
+        import numpy
+        return numpy.array(ret, dtype=numpy.float64)
+    else:
+        return ret
+
 def pretty_german_float(f, decimals=2, form=False):
     """
     Return a German representation of a float point number as a
@@ -193,3 +641,42 @@ def pretty_german_float(f, decimals=2, form=False):
         return "-" + s
     else:
         return s
+
+def pretty_german_float_column(values, decimals=2, form=False):
+    """
+    pretty_german_float() for a whole column of floats or
+    decimal.Decimals (any iterable, including a NumPy array, which is
+    converted with tolist() first). All values are formatted into one
+    string and the trailing zeros are stripped and the decimal points
+    replaced there. Return a list of strings.
+    """
+    if type(values).__module__ == "numpy":
+        values = values.tolist()
+    elif not isinstance(values, (list, tuple,)):
+        values = list(values)
+
+    if not values:
+        return []
+
+    if not set(map(type, values)) <= { float, decimal.Decimal, }:
+        return [ pretty_german_float(f, decimals, form) for f in values ]
+
+    # "%f" of -f is "-" + "%f" of f, so this is the same as
+    # pretty_german_float()’s sign handling.
+    s = "\n".join(map("%f".__mod__, values)) + "\n"
+
+    if "n" in s:
+        # nan or inf, which have no decimal point to split at.
+        for f in values:
+            pretty_german_float(f)
+
+    # %f always has six decimals, so no more than six trailing zeros.
+    # The decimal point stays until the end: Without it the integer
+    # part’s zeros would be taken off, too.
+    for zeros in ( "00000\n", "0000\n", "000\n", "00\n", "0\n", ):
+        s = s.replace(zeros, "\n")
+    s = s.replace(".\n", "\n").replace(".", ",")
+
+    ret = s.split("\n")
+    ret.pop()
+    return ret
@@ -1,4 +1,4 @@
-import json, urllib.parse
+import json, re, html, functools, itertools, urllib.parse
 
 def js_string_literal(s):
     return json.dumps(s)
@@ -10,22 +10,327 @@ def add_url_param(url, params={}):
     else:
         return url + "?" + params
 
+class url_builder:
+    """
+    A URL parsed once, from which many variants with different query
+    parameters can be derived cheaply, e.g. for pagination links.
+
+    The query is kept as an ordered multi-dict, so repeated keys
+    (?tag=a&tag=b) survive. Values are grouped by key in the order of
+    the keys’ first appearance. Each parameter is encoded once, when it
+    is parsed or set, and derived builders share the encoded form of
+    the parameters they did not change.
+    """
+    def __init__(self, url):
+        url, hash, fragment = url.partition("#")
+        base, question_mark, query = url.partition("?")
+
+        self.base = base
+        self.fragment = fragment if hash else None
+
+        self.params = {}
+        for key, value in urllib.parse.parse_qsl(query,
+                                                 keep_blank_values=True):
+            self.params[key] = self.params.get(key, ()) + ( value, )
+
+        self._encoded = { key: self._encode(key, values)
+                          for key, values in self.params.items() }
+
+    def _derive(self):
+        ret = url_builder.__new__(url_builder)
+        ret.base = self.base
+        ret.fragment = self.fragment
+        ret.params = dict(self.params)
+        ret._encoded = dict(self._encoded)
+        return ret
+
+    @staticmethod
+    def _encode(key, values):
+        return urllib.parse.urlencode([ ( key, value, ) for value in values ])
+
+    @staticmethod
+    def _values(value):
+        if isinstance(value, (list, tuple,)):
+            return tuple(str(v) for v in value)
+        else:
+            return ( str(value), )
+
+    def set(self, params={}, **kw):
+        """
+        Return a new url_builder with the parameters in `params` (and the
+        keyword arguments) replaced. A value of None removes the
+        parameter, a list or tuple sets several values for its key.
+        """
+        ret = self._derive()
+        for key, value in dict(params, **kw).items():
+            if value is None:
+                ret.params.pop(key, None)
+                ret._encoded.pop(key, None)
+            else:
+                values = self._values(value)
+                ret.params[key] = values
+                ret._encoded[key] = self._encode(key, values)
+        return ret
+
+    def add(self, params={}, **kw):
+        """
+        Return a new url_builder with the values in `params` (and the
+        keyword arguments) appended to those already present.
+        """
+        ret = self._derive()
+        for key, value in dict(params, **kw).items():
+            values = ret.params.get(key, ()) + self._values(value)
+            ret.params[key] = values
+            ret._encoded[key] = self._encode(key, values)
+        return ret
+
+    def remove(self, *keys):
+        return self.set({ key: None for key in keys })
+
+    def get(self, key, default=None):
+        values = self.params.get(key)
+        if values:
+            return values[0]
+        else:
+            return default
+
+    def getall(self, key):
+        return list(self.params.get(key, ()))
+
+    def query(self):
+        return "&".join(self._encoded.values())
+
+    def __str__(self):
+        ret = self.base
+
+        query = self.query()
+        if query:
+            ret += "?" + query
+
+        if self.fragment is not None:
+            ret += "#" + self.fragment
+
+        return ret
+
+    def __repr__(self):
+        return "<url_builder %s>" % str(self)
+
 def set_url_param(url, params={}):
-    tpl = url.split("?", 1)
-    if len(tpl) == 2:
-        url, query = tpl
-        query = urllib.parse.parse_qs(query)
-    else:
-        query = {}
-    
-    for key, value in query.items():
-        if len(value) == 1:
-            query[key] = value[0]
-    query.update(params)
-    
-    for key, value in params.items():
-        if value is None:
-            del query[key]
-            
-    return "%s?%s" % (url, urllib.parse.urlencode(query),)
+    """
+    Return `url` with the query parameters in `params` replaced. A value
+    of None removes the parameter. Use a url_builder to derive many URLs
+    from the same one.
+    """
+    return str(url_builder(url).set(params))
+
+_attribute_value = r'''(?:"[^"]*"|'[^']*'|[^\s"'>]+)'''
+_tag_re = re.compile(r'''<([a-zA-Z][^\s/>]*)(?:\s+[^\s=/>]+(?:\s*=\s*%s)?)*\s*/?>'''
+                     % _attribute_value)
+_partial_tag_re = re.compile(
+    r'''<(?:[a-zA-Z][^\s/>]*(?:\s+[^\s=/>]+(?:\s*=\s*%s)?)*\s*'''
+    r'''(?:[^\s=/>]+\s*(?:=\s*(?:"[^"]*|'[^']*)?)?)?/?)?\Z''' % _attribute_value)
+_tag_name_re = re.compile(r"<[^\s/>]*")
+_attribute_re = re.compile(r'''(\s+)([^\s=/>]+)(?:(\s*=\s*)(%s))?'''
+                           % _attribute_value)
+_comment_re = re.compile(r"<!--.*?-->", re.DOTALL)
+_end_tag_re = re.compile(r"</([a-zA-Z][^\s/>]*)\s*>")
+_partial_end_tag_re = re.compile(r"</(?:[a-zA-Z][^\s/>]*\s*)?\Z")
+_declaration_re = re.compile(r"<[!?][^>]*>")
+_partial_declaration_re = re.compile(r"<[!?][^>]*\Z")
+
+def skip_url(url):
+    """
+    Is `url` one that a link policy should leave alone: an in-page
+    anchor, mailto:, javascript:, data: and the like?
+    """
+    url = url.strip()
+    if url.startswith("#") or not url:
+        return True
+    scheme, colon, rest = url.partition(":")
+    return ( colon and "/" not in scheme
+             and scheme.lower() not in ( "http", "https", ) )
+
+def param_policy(params, hosts=None):
+    """
+    Return a link_rewriter policy that sets the query parameters in
+    `params` (see url_builder.set()) on every http(s) and relative URL.
+    If `hosts` is given, absolute URLs must point to one of them.
+    """
+    def policy(url):
+        if skip_url(url):
+            return None
+
+        if hosts is not None and "//" in url:
+            host = urllib.parse.urlsplit(url).hostname
+            if host not in hosts:
+                return None
+
+        return str(url_builder(url).set(params))
+
+    return policy
+
+class link_rewriter:
+    """
+    Rewrite the URLs in the `attributes` of all tags in an HTML document
+    as it streams by. `policy` is called with each (unescaped) URL and
+    returns a new URL or None to leave it alone. Its results are cached
+    for the last `cache_size` distinct URLs, so re-use one link_rewriter
+    for many pages.
+
+    Comments and the contents of <script> and <style> are passed through
+    untouched. Only a tag cut in half by a chunk boundary is buffered.
+    """
+    raw_text_elements = { "script", "style", }
+
+    # Incomplete markup longer than this is passed through as text.
+    max_held = 64 * 1024
+
+    def __init__(self, policy, attributes=( "href", "src", ),
+                 cache_size=4096):
+        self.policy = policy
+        self.attributes = { a.lower() for a in attributes }
+        self.rewrite_value = functools.lru_cache(maxsize=cache_size)(
+            self._rewrite_value)
+
+    def _rewrite_value(self, value):
+        """
+        Return the new (quoted) attribute value for `value` as it appears
+        in the source, quotes and all.
+        """
+        if value[:1] in "\"'":
+            quote, url = value[0], value[1:-1]
+        else:
+            quote, url = '"', value
+
+        new = self.policy(html.unescape(url))
+        if new is None:
+            return value
+        else:
+            return quote + html.escape(new) + quote
+
+    def rewrite_tag(self, tag):
+        """
+        Rewrite the URL attributes of a complete start `tag`. Its
+        attributes are walked in order, so that text inside another
+        attribute’s quoted value is never mistaken for one.
+        """
+        pos = _tag_name_re.match(tag).end()
+        out = [ tag[:pos], ]
+        for match in _attribute_re.finditer(tag, pos):
+            out.append(tag[pos:match.start()])
+            space, name, equals, value = match.groups()
+            if value is not None and name.lower() in self.attributes:
+                out.append(space + name + equals + self.rewrite_value(value))
+            else:
+                out.append(match.group())
+            pos = match.end()
+        out.append(tag[pos:])
+        return "".join(out)
+
+    def rewrite(self, chunks):
+        """
+        Yield the rewritten document for an iterable of str `chunks`.
+        """
+        for kind, text, name in html_tokens(chunks, self.raw_text_elements,
+                                            self.max_held):
+            if kind == "start":
+                yield self.rewrite_tag(text)
+            else:
+                yield text
+
+    def rewrite_string(self, s):
+        return "".join(self.rewrite([ s, ]))
+
+def html_tokens(chunks, raw_text_elements=( "script", "style", ),
+                max_held=64*1024):
+    """
+    Split an HTML document given as an iterable of str `chunks` into
+    ( kind, text, name, ) tuples as it streams by. Kind is one of "text",
+    "start" (a start or empty element tag), "end" (an end tag),
+    "comment", "declaration" (<!DOCTYPE …> or <?…?>) or "raw" (the
+    contents of one of the `raw_text_elements`). Name is the lower case
+    tag name for start and end tags and None otherwise. "".join() of all
+    texts is the document.
+
+    Text may come in several consecutive pieces. Only markup cut in half
+    by a chunk boundary is held back, up to `max_held` characters; longer
+    incomplete markup, and a < that does not start markup, is text.
+    """
+    buffer = ""
+    raw_text_end = None # Matches "</script" while inside a <script>.
+
+    for chunk in itertools.chain(chunks, [ None, ]):
+        final = chunk is None
+        if not final:
+            buffer += chunk
+
+        pos = 0
+        while pos < len(buffer):
+            if raw_text_end is not None:
+                match = raw_text_end.search(buffer, pos)
+                if match is None:
+                    # Keep what might be the start of the end tag.
+                    keep = 0 if final else len(raw_text_end.pattern) - 1
+                    stop = max(pos, len(buffer) - keep)
+                    if stop > pos:
+                        yield ( "raw", buffer[pos:stop], None, )
+                    pos = stop
+                    break
+                if match.start() > pos:
+                    yield ( "raw", buffer[pos:match.start()], None, )
+                pos = match.start()
+                raw_text_end = None
+
+            start = buffer.find("<", pos)
+            if start == -1:
+                yield ( "text", buffer[pos:], None, )
+                pos = len(buffer)
+                break
+
+            if start > pos:
+                yield ( "text", buffer[pos:start], None, )
+            pos = start
+
+            match = _tag_re.match(buffer, pos)
+            if match is not None:
+                name = match.group(1).lower()
+                yield ( "start", match.group(), name, )
+                pos = match.end()
+                if name in raw_text_elements:
+                    raw_text_end = re.compile("</" + name, re.IGNORECASE)
+                continue
+
+            match = _end_tag_re.match(buffer, pos)
+            if match is not None:
+                yield ( "end", match.group(), match.group(1).lower(), )
+                pos = match.end()
+                continue
+
+            if buffer.startswith("<!--", pos):
+                match = _comment_re.match(buffer, pos)
+                if match is not None:
+                    yield ( "comment", match.group(), None, )
+                    pos = match.end()
+                    continue
+                incomplete = True
+            else:
+                match = _declaration_re.match(buffer, pos)
+                if match is not None:
+                    yield ( "declaration", match.group(), None, )
+                    pos = match.end()
+                    continue
+
+                # Matched in place: Copying the rest of the buffer for
+                # every stray < would make one big chunk quadratic.
+                incomplete = not final and any(
+                    regex.match(buffer, pos) is not None
+                    for regex in ( _partial_tag_re, _partial_end_tag_re,
+                                   _partial_declaration_re, ))
+            if incomplete and not final and len(buffer) - pos < max_held:
+                break
+
+            # Not markup after all.
+            yield ( "text", "<", None, )
+            pos += 1
 
+        buffer = buffer[pos:]
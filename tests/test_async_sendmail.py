@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+Tests for t4.sendmail.async_sendmail() and its transports, against an
+SMTP server stand-in on asyncio streams and a fake sendmail binary.
+Run with python -m unittest discover tests (or pytest).
+"""
+
+import os, os.path as op, asyncio, tempfile, time, unittest, smtplib
+
+from t4 import sendmail
+
+class smtp_stand_in:
+    """
+    Just enough of an SMTP server to accept messages. With `silent`, it
+    never says a word; with `stop_reading`, it stops reading once DATA
+    starts. Recipients in `refuse` get a 550, those in `hang_up` a 421.
+    """
+    def __init__(self, silent=False, stop_reading=False, refuse=(),
+                 hang_up=()):
+        self.silent = silent
+        self.stop_reading = stop_reading
+        self.refuse = refuse
+        self.hang_up = hang_up
+        self.received = []
+        self.connections = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle,
+                                                 "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+
+        async def say(line):
+            writer.write(line.encode("ascii") + b"\r\n")
+            await writer.drain()
+
+        try:
+            if self.silent:
+                await reader.read()
+                return
+
+            await say("220 stand-in ready")
+            envelope_from, recipients = None, []
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode("ascii").strip()
+                verb = command[:4].upper()
+
+                if verb in ( "EHLO", "HELO", ):
+                    await say("250 stand-in")
+                elif verb == "MAIL":
+                    envelope_from, recipients = command[11:-1], []
+                    await say("250 OK")
+                elif verb == "RCPT":
+                    recipient = command[9:-1]
+                    if recipient in self.hang_up:
+                        await say("421 Closing")
+                        break
+                    elif recipient in self.refuse:
+                        await say("550 No such user")
+                    else:
+                        recipients.append(recipient)
+                        await say("250 OK")
+                elif verb == "DATA":
+                    await say("354 Go ahead")
+                    if self.stop_reading:
+                        await asyncio.sleep(3600)
+                    lines = []
+                    while True:
+                        line = await reader.readline()
+                        if line == b".\r\n":
+                            break
+                        if line.startswith(b".."):
+                            line = line[1:]
+                        lines.append(line)
+                    self.received.append( ( envelope_from, recipients,
+                                            b"".join(lines), ) )
+                    await say("250 Queued")
+                elif verb in ( "RSET", "NOOP", ):
+                    await say("250 OK")
+                elif verb == "QUIT":
+                    await say("221 Bye")
+                    break
+                else:
+                    await say("502 Not implemented")
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+arguments = ( "Sender", "sender@example.com",
+              "Recipient", "recipient@example.com",
+              "Subject ✓", "Hello\n.leading dot\nWorld ✓\n", )
+
+class async_smtp_transport_test(unittest.TestCase):
+    def test_delivery(self):
+        async def test():
+            server = await smtp_stand_in().start()
+            transport = sendmail.async_smtp_transport("127.0.0.1", server.port,
+                                                      pool_size=2)
+            await asyncio.gather(*[
+                sendmail.async_sendmail(*arguments, bcc=[ "bcc@example.com" ],
+                                        transport=transport)
+                for a in range(10) ])
+            await transport.close()
+            await server.close()
+            return server
+
+        server = run(test())
+        self.assertEqual(len(server.received), 10)
+        self.assertLessEqual(server.connections, 2)
+
+        envelope_from, recipients, data = server.received[0]
+        self.assertEqual(envelope_from, "sender@example.com")
+        self.assertEqual(recipients, [ "recipient@example.com",
+                                       "bcc@example.com", ])
+
+        # The same message the sync path would send.
+        composed = sendmail.compose(*arguments, bcc=[ "bcc@example.com" ])
+        expected = composed.as_string().replace("\n", "\r\n")
+        if not expected.endswith("\r\n"):
+            expected += "\r\n"
+        self.assertEqual(data.decode("utf-8"), expected)
+
+    def test_attachment(self):
+        payload = os.urandom(300 * 1024)
+
+        async def test():
+            server = await smtp_stand_in().start()
+            transport = sendmail.async_smtp_transport("127.0.0.1", server.port)
+            attachment = sendmail.sendmail_attachment("data.bin", data=payload)
+            await sendmail.async_sendmail(*arguments, attachments=[attachment],
+                                          transport=transport)
+            await transport.close()
+            await server.close()
+            return server
+
+        server = run(test())
+        import email
+        message = email.message_from_bytes(server.received[0][2])
+        self.assertEqual(message.get_payload()[1].get_payload(decode=True),
+                         payload)
+
+    def test_refused(self):
+        async def test():
+            server = await smtp_stand_in(
+                refuse=( "recipient@example.com", )).start()
+            transport = sendmail.async_smtp_transport("127.0.0.1", server.port)
+            try:
+                await sendmail.async_sendmail(*arguments, transport=transport)
+            finally:
+                await transport.close()
+                await server.close()
+
+        self.assertRaises(smtplib.SMTPRecipientsRefused, run, test())
+
+    def test_hang_up_during_rcpt(self):
+        # Nothing was delivered, so this must not look like a partial
+        # refusal.
+        async def test():
+            server = await smtp_stand_in(
+                hang_up=( "recipient@example.com", )).start()
+            transport = sendmail.async_smtp_transport("127.0.0.1", server.port)
+            try:
+                await sendmail.async_sendmail(*arguments,
+                                              bcc=[ "bcc@example.com" ],
+                                              transport=transport)
+            finally:
+                await transport.close()
+                await server.close()
+                self.assertEqual(server.received, [])
+
+        self.assertRaises(smtplib.SMTPServerDisconnected, run, test())
+
+    def test_reply_timeout(self):
+        async def test():
+            server = await smtp_stand_in(silent=True).start()
+            transport = sendmail.async_smtp_transport(
+                "127.0.0.1", server.port, timeout=0.3)
+            try:
+                await sendmail.async_sendmail(*arguments, transport=transport)
+            finally:
+                await server.close()
+
+        start = time.monotonic()
+        self.assertRaises(asyncio.TimeoutError, run, test())
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_drain_timeout(self):
+        # A server that stops reading in the middle of DATA.
+        async def test():
+            server = await smtp_stand_in(stop_reading=True).start()
+            transport = sendmail.async_smtp_transport(
+                "127.0.0.1", server.port, timeout=0.3)
+            attachment = sendmail.sendmail_attachment(
+                "big.bin", data=b"\0" * (32 * 1024 * 1024))
+            try:
+                await sendmail.async_sendmail(*arguments,
+                                              attachments=[attachment],
+                                              transport=transport)
+            finally:
+                await server.close()
+
+        start = time.monotonic()
+        self.assertRaises(asyncio.TimeoutError, run, test())
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_loop_stays_responsive(self):
+        async def test():
+            server = await smtp_stand_in().start()
+            transport = sendmail.async_smtp_transport("127.0.0.1", server.port)
+            attachment = sendmail.sendmail_attachment(
+                "big.bin", data=os.urandom(4 * 1024 * 1024))
+
+            ticks = 0
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.005)
+                    ticks += 1
+
+            task = asyncio.create_task(ticker())
+            start = time.monotonic()
+            await sendmail.async_sendmail(*arguments, attachments=[attachment],
+                                          transport=transport)
+            elapsed = time.monotonic() - start
+            task.cancel()
+            await transport.close()
+            await server.close()
+            return ticks, elapsed
+
+        ticks, elapsed = run(test())
+        # The ticker ran throughout, not only before and after.
+        self.assertGreater(ticks, elapsed / 0.005 / 4)
+
+fake_sendmail = """#!/bin/sh
+if [ "$3" = "fail@example.com" ]; then echo "no such user" >&2; exit 67; fi
+if [ "$3" = "slow@example.com" ]; then sleep 10; fi
+cat > "$(dirname "$0")/$$.eml"
+"""
+
+@unittest.skipUnless(op.exists("/bin/sh"), "needs /bin/sh")
+class async_sendmail_binary_transport_test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = op.join(self.directory.name, "sendmail")
+        with open(self.path, "w") as fp:
+            fp.write(fake_sendmail)
+        os.chmod(self.path, 0o755)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def messages(self):
+        return [ name for name in os.listdir(self.directory.name)
+                 if name.endswith(".eml") ]
+
+    def test_delivery(self):
+        transport = sendmail.async_sendmail_binary_transport(
+            self.path, max_processes=4)
+
+        async def test():
+            await asyncio.gather(*[
+                sendmail.async_sendmail(*arguments, transport=transport)
+                for a in range(10) ])
+
+        run(test())
+        messages = self.messages()
+        self.assertEqual(len(messages), 10)
+
+        with open(op.join(self.directory.name, messages[0]),
+                  encoding="utf-8") as fp:
+            self.assertEqual(fp.read(),
+                             sendmail.compose(*arguments).as_string())
+
+    def test_failure(self):
+        transport = sendmail.async_sendmail_binary_transport(self.path)
+        failing = arguments[:3] + ( "fail@example.com", ) + arguments[4:]
+
+        with self.assertRaises(IOError) as context:
+            run(sendmail.async_sendmail(*failing, transport=transport))
+        self.assertIn("no such user", str(context.exception))
+
+    def test_timeout(self):
+        transport = sendmail.async_sendmail_binary_transport(self.path,
+                                                             timeout=0.5)
+        slow = arguments[:3] + ( "slow@example.com", ) + arguments[4:]
+
+        start = time.monotonic()
+        self.assertRaises(asyncio.TimeoutError, run,
+                          sendmail.async_sendmail(*slow, transport=transport))
+        self.assertLess(time.monotonic() - start, 5)
+
+if __name__ == "__main__":
+    unittest.main()
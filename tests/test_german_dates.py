@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+Tests for t4.typography.parse_german_dates() and format_german_dates(),
+which must return what the scalar functions do.
+
+Run python -m tests.test_german_dates benchmark from the top directory to
+time both on a 1M-row import column instead.
+"""
+
+import sys, random, datetime, time, unittest
+
+from t4.typography import ( parse_german_date, parse_german_dates,
+                            pretty_german_date, format_german_dates, )
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def import_column(rng, rows, distinct=3000):
+    """
+    `rows` date strings as they come in an import file: `distinct`
+    different dates, and now and then something that is not one.
+    """
+    start = datetime.date(1990, 1, 1).toordinal()
+    dates = [ datetime.date.fromordinal(start + rng.randrange(15000))
+              for a in range(distinct) ]
+    strings = [ "%i.%i.%i" % ( d.day, d.month, d.year, ) for d in dates ]
+    bad = [ "", "31.2.2020", "n/a", "2020-01-01", "1.1.20", None, 17, ]
+
+    return [ rng.choice(bad) if rng.random() < 0.01 else rng.choice(strings)
+             for a in range(rows) ]
+
+def scalar_parse(values):
+    dates, errors = [], []
+    for index, value in enumerate(values):
+        try:
+            dates.append(parse_german_date(value))
+        except (ValueError, TypeError) as exc:
+            dates.append(None)
+            errors.append( ( index, value, exc, ) )
+    return dates, errors
+
+class german_dates_test(unittest.TestCase):
+    def test_parse(self):
+        values = import_column(random.Random(1), 20000, 300)
+        for cache_size in ( 65536, 10, 0, ):
+            dates, errors = parse_german_dates(values, cache_size=cache_size)
+            expected, expected_errors = scalar_parse(values)
+            self.assertEqual(dates, expected)
+            self.assertEqual([ ( index, value, ) for index, value, e in errors ],
+                             [ ( index, value, )
+                               for index, value, e in expected_errors ])
+
+    def test_unhashable(self):
+        dates, errors = parse_german_dates([ "1.2.2003", [ "1.2.2003" ], ])
+        self.assertEqual(dates, [ datetime.date(2003, 2, 1), None, ])
+        self.assertEqual([ index for index, value, e in errors ], [ 1, ])
+
+    def test_format(self):
+        rng = random.Random(2)
+        values = [ datetime.datetime(2000, 1, 1)
+                   + datetime.timedelta(minutes=rng.randrange(10**6))
+                   for a in range(5000) ] + [ None, "x", ]
+        for with_time in ( False, True, ):
+            for monthname in ( False, True, ):
+                strings, errors = format_german_dates(
+                    values, with_time, monthname=monthname)
+                self.assertEqual(strings[:-1], [
+                    pretty_german_date(v, with_time, monthname=monthname)
+                    for v in values[:-1] ])
+                self.assertEqual(strings[-1], None)
+                self.assertEqual([ index for index, value, e in errors ],
+                                 [ len(values) - 1, ])
+
+    @unittest.skipIf(numpy is None, "needs NumPy")
+    def test_datetime64(self):
+        values = import_column(random.Random(3), 5000, 300)
+        dates, errors = parse_german_dates(values, datetime64=True)
+        expected, expected_errors = scalar_parse(values)
+
+        self.assertEqual(dates.dtype, numpy.dtype("datetime64[D]"))
+        self.assertEqual([ None if numpy.isnat(d) else d.item()
+                           for d in dates ], expected)
+
+        strings, errors = format_german_dates(dates)
+        self.assertEqual(strings, [ pretty_german_date(d) for d in expected ])
+        self.assertEqual(errors, [])
+
+def best_of(function, repeat=3):
+    """
+    The fastest of `repeat` calls to function() in seconds.
+    """
+    best = None
+    for a in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def benchmark():
+    values = import_column(random.Random(4), 1000000)
+    dates = parse_german_dates(values)[0]
+
+    print("1M rows, 3,000 different dates, 1% bad values; best of 3")
+    for name, function in (
+            ( "parse, scalar try/except loop",
+              lambda: scalar_parse(values), ),
+            ( "parse_german_dates()",
+              lambda: parse_german_dates(values), ), ):
+        print("%-40s %6.2f s" % ( name, best_of(function), ))
+
+    if numpy is not None:
+        print("%-40s %6.2f s" % (
+            "parse_german_dates(datetime64=True)",
+            best_of(lambda: parse_german_dates(values, datetime64=True)), ))
+
+    print("%-40s %6.2f s" % (
+        "format, scalar loop",
+        best_of(lambda: [ pretty_german_date(d) for d in dates ]), ))
+    print("%-40s %6.2f s" % (
+        "format_german_dates()",
+        best_of(lambda: format_german_dates(dates)), ))
+
+if __name__ == "__main__":
+    if sys.argv[1:] == [ "benchmark", ]:
+        benchmark()
+    else:
+        unittest.main()
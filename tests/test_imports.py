@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+Tests that the t4 modules leave their heavy and optional dependencies
+alone until they are needed, and that these are still reachable as
+module attributes.
+
+Run python -m tests.test_imports benchmark from the top directory to
+print python -X importtime figures for each module, on its own and with
+the imports it defers.
+"""
+
+import sys, os.path as op, subprocess, unittest
+
+top = op.dirname(op.dirname(op.abspath(__file__)))
+
+# The modules each t4 module imports only on first use.
+deferred = {
+    "t4.typography": [ "t4.sql", "sqlclasses", "numpy", ],
+    "t4.sendmail": [ "smtplib", "socket", "subprocess", "uuid", "mimetypes",
+                     "email.mime.multipart", "email.mime.text",
+                     "email.header", "email.utils", "ll.xist", ],
+    "t4.passwords": [ "asyncio", "concurrent.futures", "subprocess", ],
+    "t4.mailspool": [ "smtplib", "email.mime.multipart", ], }
+
+def python(code, *options):
+    """
+    Run `code` in a fresh interpreter and return its stdout and stderr.
+    """
+    process = subprocess.run([ sys.executable, ] + list(options)
+                             + [ "-c", code, ],
+                             cwd=top, capture_output=True, text=True,
+                             check=True)
+    return process.stdout, process.stderr
+
+class lazy_import_test(unittest.TestCase):
+    def test_deferred(self):
+        for module, names in deferred.items():
+            stdout, stderr = python(
+                "import sys, %s; print(' '.join(sorted(sys.modules)))"
+                % module)
+            loaded = set(stdout.split())
+            for name in names:
+                self.assertNotIn(name, loaded, module)
+
+    def test_attributes(self):
+        stdout, stderr = python(
+            "import t4\n"
+            "print(t4.typography.normalize_whitespace(' a \\n b '))\n"
+            "print(t4.sendmail.MIMEText.__name__, "
+            "t4.sendmail.smtplib.__name__, t4.sendmail.Header.__name__)\n")
+        self.assertEqual(stdout.split("\n")[:2],
+                         [ "a b", "MIMEText smtplib Header", ])
+
+def top_level_imports(code):
+    """
+    Yield ( name, cumulative microseconds, ) for each top level import
+    python -X importtime reports for `code`.
+    """
+    stdout, stderr = python(code, "-X", "importtime")
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative, name = line[12:].split("|")
+        # Nested imports are indented, and included in the cumulative
+        # time of the top level import they are part of.
+        if cumulative.strip().isdigit() and not name[1:].startswith(" "):
+            yield name.strip(), int(cumulative)
+
+def import_time(code):
+    """
+    How long `code`’s imports take in milliseconds, leaving out those
+    the interpreter does on startup.
+    """
+    startup = { name for name, us in top_level_imports("pass") }
+    return sum( us for name, us in top_level_imports(code)
+                if name not in startup ) / 1000
+
+def benchmark(repeat=5):
+    print("python -X importtime, best of %i" % repeat)
+    print("%-16s %12s %24s" % ( "module", "ms", "with deferred imports ms", ))
+    for module, names in deferred.items():
+        available = []
+        for name in names:
+            try:
+                python("import " + name)
+            except subprocess.CalledProcessError:
+                pass
+            else:
+                available.append(name)
+
+        alone = min(import_time("import " + module) for a in range(repeat))
+        eager = min(import_time("import " + ", ".join([ module, ] + available))
+                    for a in range(repeat))
+        print("%-16s %12.1f %24.1f" % ( module, alone, eager, ))
+
+if __name__ == "__main__":
+    if sys.argv[1:] == [ "benchmark", ]:
+        benchmark()
+    else:
+        unittest.main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+Tests for t4.mailspool: what happens to a spooled message when the SMTP
+server refuses some or all of its recipients.
+"""
+
+import os, os.path as op, json, tempfile, unittest, smtplib
+
+from t4 import sendmail, mailspool
+
+class fake_server:
+    """
+    Hand out fake smtplib connections that answer RCPT with the code in
+    `codes` for a recipient, 250 for everyone else, and record what is
+    sent.
+    """
+    def __init__(self, codes={}):
+        self.codes = codes
+        self.received = [] # ( recipients, data, ) pairs.
+        self.data_commands = 0
+
+    def connection(self):
+        return fake_connection(self)
+
+class fake_connection:
+    def __init__(self, server):
+        self.server = server
+        self.accepted = []
+        self.data = []
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def mail(self, envelope_from):
+        self.accepted = []
+        return ( 250, b"OK", )
+
+    def rcpt(self, recipient):
+        code = self.server.codes.get(recipient, 250)
+        if code == 250:
+            self.accepted.append(recipient)
+        return ( code, b"Said the fake", )
+
+    def docmd(self, command):
+        self.server.data_commands += 1
+        self.data = []
+        return ( 354, b"Go ahead", )
+
+    def send(self, data):
+        self.data.append(data)
+
+    def getreply(self):
+        self.server.received.append( ( self.accepted, b"".join(self.data), ) )
+        return ( 250, b"Queued", )
+
+    def sendmail(self, envelope_from, recipients, message):
+        # What smtplib does with a 421 during RCPT.
+        self.mail(envelope_from)
+        for recipient in recipients:
+            code, response = self.rcpt(recipient)
+            if code == 421:
+                raise smtplib.SMTPRecipientsRefused(
+                    { recipient: ( code, response, ), })
+        return {}
+
+    def rset(self):
+        return ( 250, b"OK", )
+
+    def noop(self):
+        return ( 250, b"OK", )
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+class fake_transport(sendmail.smtp_transport):
+    def __init__(self, server):
+        super().__init__("localhost")
+        self.server = server
+
+    def _connect(self):
+        return self.server.connection()
+
+message = "From: a@example.com\nSubject: Test\n\nHello\n"
+recipients = [ "a@example.com", "b@example.com", "c@example.com", ]
+
+class mail_spool_test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def spool(self, codes):
+        self.server = fake_server(codes)
+        return mailspool.mail_spool(self.directory.name,
+                                    fake_transport(self.server))
+
+    def envelopes(self, subdir):
+        ret = []
+        path = op.join(self.directory.name, subdir)
+        for filename in sorted(os.listdir(path)):
+            if not filename.endswith(".error"):
+                with open(op.join(path, filename), encoding="utf-8") as fp:
+                    ret.append(json.loads(fp.readline()))
+        return ret
+
+    def test_delivery(self):
+        spool = self.spool({})
+        spool.enqueue_composed("sender@example.com", recipients, message)
+        self.assertTrue(spool.process_one())
+
+        self.assertEqual(self.server.received,
+                         [ ( recipients,
+                             message.replace("\n", "\r\n").encode("ascii")
+                             + b".\r\n", ), ])
+        for subdir in ( "new", "cur", "dead", ):
+            self.assertEqual(self.envelopes(subdir), [], subdir)
+
+    def test_disconnect_during_rcpt(self):
+        # A 421 for b ends the session before DATA: Nobody got the
+        # message, so it is re-spooled for all three.
+        spool = self.spool({ "b@example.com": 421, })
+        spool.enqueue_composed("sender@example.com", recipients, message)
+        self.assertTrue(spool.process_one())
+
+        self.assertEqual(self.server.data_commands, 0)
+        self.assertEqual([ envelope["recipients"]
+                           for envelope in self.envelopes("new") ],
+                         [ recipients, ])
+        self.assertEqual(self.envelopes("cur"), [])
+        self.assertEqual(self.envelopes("dead"), [])
+
+    def test_partial_refusal(self):
+        # a gets the message, b is re-tried later and c is given up on.
+        spool = self.spool({ "b@example.com": 450, "c@example.com": 550, })
+        spool.enqueue_composed("sender@example.com", recipients, message)
+        self.assertTrue(spool.process_one())
+
+        self.assertEqual([ r for r, data in self.server.received ],
+                         [ [ "a@example.com", ], ])
+
+        new = self.envelopes("new")
+        self.assertEqual([ envelope["recipients"] for envelope in new ],
+                         [ [ "b@example.com", ], ])
+        self.assertEqual(new[0]["attempts"], 1)
+
+        self.assertEqual(self.envelopes("cur"), [])
+        self.assertEqual([ envelope["recipients"]
+                           for envelope in self.envelopes("dead") ],
+                         [ [ "c@example.com", ], ])
+        dead = os.listdir(op.join(self.directory.name, "dead"))
+        self.assertEqual(len([ name for name in dead
+                               if name.endswith(".error") ]), 1)
+
+    def test_all_refused(self):
+        spool = self.spool(dict( ( recipient, 550, )
+                                 for recipient in recipients ))
+        spool.enqueue_composed("sender@example.com", recipients, message)
+        self.assertTrue(spool.process_one())
+
+        self.assertEqual(self.server.data_commands, 0)
+        self.assertEqual(self.envelopes("new"), [])
+        self.assertEqual([ envelope["recipients"]
+                           for envelope in self.envelopes("dead") ],
+                         [ recipients, ])
+
+    def test_421_with_str_message(self):
+        transport = fake_transport(fake_server({ "b@example.com": 421, }))
+        self.assertRaises(smtplib.SMTPServerDisconnected, transport.deliver,
+                          "sender@example.com", recipients, message)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+Tests for the batch password and slug generators in t4.passwords.
+
+Run python -m tests.test_passwords benchmark from the top directory to
+print their throughput next to that of the random module based functions
+they replaced.
+"""
+
+import os, sys, random, time, unittest, collections, itertools
+
+from t4.passwords import ( random_passwords, random_password, slugs, slug,
+                           apple_style_random_passwords, password_letters,
+                           password_digits, password_specials, )
+
+def reference_random_password(length=8, use_specials=True):
+    """
+    random_password() as it was before the batch generators.
+    """
+    letters = "ABCDEFGHJKLMNPQRSTUVWYXZabcdefghijkmnpqrstuvwyxz"
+    digits = "0123456789"
+    characters = letters + digits
+
+    ret = []
+    ret.append(random.choice(letters))
+    for a in range(length-1):
+        ret.append(random.choice(characters))
+
+    if use_specials and length > 2:
+        ret = ret[:-1]
+        idx = random.randint(1, length-2)
+        ret.insert(idx, random.choice(password_specials))
+
+    return "".join(ret)
+
+def reference_apple_style_random_password(groupnum=4, grouplength=3):
+    letters = "ABCDEFGHJKLMNPQRSTUVWYXZabcdefghijkmnpqrstuvwyxz"
+    digits = "0123456789"
+    characters = letters + digits
+
+    def groups():
+        while True:
+            yield "".join(random.sample(characters, grouplength))
+
+    groups = itertools.islice(groups(), groupnum)
+    ret = "-".join(groups)
+
+    for d in digits:
+        if d in ret:
+            return ret
+    else:
+        return ret[:-1] + random.sample(digits, 1)[0]
+
+alphanumeric = set(password_letters + password_digits)
+
+class passwords_test(unittest.TestCase):
+    def test_random_passwords(self):
+        for password in random_passwords(1000, 12):
+            self.assertEqual(len(password), 12)
+            self.assertIn(password[0], password_letters)
+            specials = [ a for a, char in enumerate(password)
+                         if char in password_specials ]
+            self.assertEqual(len(specials), 1, password)
+            self.assertTrue(1 <= specials[0] <= 10, password)
+            self.assertLessEqual(set(password) - set(password_specials),
+                                 alphanumeric)
+
+    def test_slugs(self):
+        for s in slugs(1000, 10):
+            self.assertEqual(len(s), 10)
+            self.assertIn(s[0], password_letters)
+            self.assertLessEqual(set(s), alphanumeric)
+
+    def test_apple_style(self):
+        for password in apple_style_random_passwords(1000):
+            groups = password.split("-")
+            self.assertEqual([ len(group) for group in groups ], [ 3 ] * 4)
+            for group in groups:
+                self.assertEqual(len(set(group)), 3, password)
+            self.assertTrue(set(password) & set(password_digits), password)
+
+    def test_uniform(self):
+        # Each letter comes up 2000 times on average, with a standard
+        # deviation of about 44. A modulo bias would be 10% or more.
+        counts = collections.Counter(slugs(48 * 2000, length=1))
+        self.assertEqual(set(counts), set(password_letters))
+        for char, count in counts.items():
+            self.assertTrue(1700 < count < 2300, ( char, count, ))
+
+    def test_unique(self):
+        self.assertEqual(sorted(slugs(48, length=1, unique=True)),
+                         sorted(password_letters))
+        self.assertRaises(ValueError, slugs, 49, length=1, unique=True)
+        self.assertEqual(len(set(random_passwords(10000, 4, unique=True))),
+                         10000)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs os.fork()")
+    def test_fork(self):
+        # Forked children must not hand out what the parent buffered.
+        slug()
+        readers = []
+        for a in range(3):
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.write(w, slug().encode("ascii"))
+                os._exit(0)
+            os.close(w)
+            os.waitpid(pid, 0)
+            with os.fdopen(r) as fp:
+                readers.append(fp.read())
+        self.assertEqual(len(set(readers)), 3, readers)
+
+def best_of(function, repeat=5):
+    """
+    The fastest of `repeat` calls to function() in milliseconds.
+    """
+    best = None
+    for a in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+def benchmark():
+    n = 100000
+    print("%-40s %12s" % ( "100k of each", "ms", ))
+    for name, function in (
+            ( "slug(), old, loop",
+              lambda: [ reference_random_password(10, False)
+                        for a in range(n) ], ),
+            ( "slug(), loop",
+              lambda: [ slug() for a in range(n) ], ),
+            ( "slugs()",
+              lambda: slugs(n), ),
+            ( "slugs(unique=True)",
+              lambda: slugs(n, unique=True), ),
+            ( "random_password(), old, loop",
+              lambda: [ reference_random_password() for a in range(n) ], ),
+            ( "random_password(), loop",
+              lambda: [ random_password() for a in range(n) ], ),
+            ( "random_passwords()",
+              lambda: random_passwords(n), ),
+            ( "apple_style_random_password(), old, loop",
+              lambda: [ reference_apple_style_random_password()
+                        for a in range(n) ], ),
+            ( "apple_style_random_passwords()",
+              lambda: apple_style_random_passwords(n), ), ):
+        print("%-40s %12.1f" % ( name, best_of(function, 3), ))
+
+if __name__ == "__main__":
+    if sys.argv[1:] == [ "benchmark", ]:
+        benchmark()
+    else:
+        unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+Tests for t4.res.is_valid_email_address(): a differential fuzz test
+against email_re, which it replaced as the validator, and a check that
+its time grows linearly on hostile input.
+
+Run python -m tests.test_res benchmark from the top directory to print
+the timings of both on hostile inputs instead.
+"""
+
+import sys, re, random, time, unittest
+
+from t4.res import email_re, is_valid_email_address, invalid_email_addresses
+
+# The characters that matter to either, with the separators repeated so
+# they come up more often.
+alphabet = "aZ09-._+'!#@@..--" + "é "
+
+# A top level domain email_re accepts as well: 2 to 4 letters.
+plain_tld_re = re.compile(r"\.[a-zA-Z]{2,4}\Z")
+
+def random_address(rng):
+    def part(characters, length):
+        return "".join(rng.choice(characters) for a in range(length))
+
+    local_part = ".".join(part("abcXYZ019-_+!#$%&'*/=?^`{|}~",
+                               rng.randint(1, 6))
+                          for a in range(rng.randint(1, 3)))
+    labels = [ part("abcxyz0189", 1) + part("abc01-", rng.randint(0, 5))
+               + part("xyz89", 1)
+               for a in range(rng.randint(1, 3)) ]
+    tld = part("abcdefghijklmnopqrstuvwxyzDE", rng.randint(2, 4))
+    return local_part + "@" + ".".join(labels + [ tld, ])
+
+# Inputs that make backtracking matchers slow, by length.
+hostile = {
+    "letters": lambda n: "a" * n,
+    "dotted local part": lambda n: "a." * (n // 2),
+    "no top level domain": lambda n: "a@" + "a." * (n // 2 - 1),
+    "dashes": lambda n: "a@" + "a-" * (n // 2 - 1),
+    "many @": lambda n: "a@" * (n // 2),
+    "almost valid": lambda n: "a" * (n - 8) + "@b.de..x", }
+
+class email_address_test(unittest.TestCase):
+    def test_random_strings(self):
+        rng = random.Random(20)
+        for a in range(100000):
+            s = "".join(rng.choice(alphabet)
+                        for b in range(rng.randint(0, 14)))
+            self.check(s)
+
+    def test_generated_addresses(self):
+        rng = random.Random(21)
+        for a in range(50000):
+            address = random_address(rng)
+            self.assertTrue(is_valid_email_address(address), address)
+            self.check(address)
+
+            # One character changed or inserted.
+            index = rng.randrange(len(address))
+            self.check(address[:index] + rng.choice(alphabet)
+                       + address[index+1:])
+            self.check(address[:index] + rng.choice(alphabet)
+                       + address[index:])
+
+    def check(self, s):
+        valid = is_valid_email_address(s)
+
+        # Everything email_re accepted as a whole is still valid, and
+        # everything valid starts with an address email_re accepts.
+        if email_re.fullmatch(s) is not None:
+            self.assertTrue(valid, s)
+        if valid:
+            self.assertIsNotNone(email_re.match(s), s)
+
+        # For the top level domains email_re knows, the two agree.
+        if plain_tld_re.search(s) is not None:
+            self.assertEqual(valid, email_re.fullmatch(s) is not None, s)
+
+    def test_longer_top_level_domains(self):
+        for address in ( "info@example.museum", "a@b.xn--p1ai", ):
+            self.assertTrue(is_valid_email_address(address), address)
+        for address in ( "a@b.d", "a@b.1de", "a@b.de<script>", "a@b..de",
+                         ".a@b.de", "a.@b.de", "a..b@c.de", "a@-b.de",
+                         "a@b-.de", "@b.de", "a@", "a", "", ):
+            self.assertFalse(is_valid_email_address(address), address)
+
+    def test_invalid_email_addresses(self):
+        self.assertEqual(invalid_email_addresses(
+            [ "a@b.de", "nope", "c@d.com", "x@y", ]),
+                         [ ( 1, "nope", ), ( 3, "x@y", ), ])
+
+    def test_linear_time(self):
+        # Ten times the input may take ten times as long, not a hundred
+        # times. The allowance (and the millisecond on top, for inputs
+        # that take next to no time) keeps a loaded machine from failing
+        # this without making a quadratic scanner pass.
+        for name, make in hostile.items():
+            small, large = make(100000), make(1000000)
+            small_ms = best_of(lambda: is_valid_email_address(small), 3)
+            large_ms = best_of(lambda: is_valid_email_address(large), 3)
+            self.assertLess(large_ms, 30 * small_ms + 1, name)
+
+def best_of(function, repeat=5):
+    """
+    The fastest of `repeat` calls to function() in milliseconds.
+    """
+    best = None
+    for a in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+def benchmark():
+    print("%-22s %8s %12s %12s" % ( "input", "length", "email_re ms",
+                                     "scanner ms", ))
+    for name, make in hostile.items():
+        for n in ( 10000, 100000, ):
+            s = make(n)
+            print("%-22s %8i %12.2f %12.2f" % (
+                name, n,
+                best_of(lambda: email_re.fullmatch(s)),
+                best_of(lambda: is_valid_email_address(s)), ))
+
+    rng = random.Random(22)
+    addresses = [ random_address(rng) for a in range(100000) ]
+    print("%-22s %8i %12.2f %12.2f" % (
+        "100k addresses", len(addresses),
+        best_of(lambda: [ email_re.fullmatch(a) for a in addresses ]),
+        best_of(lambda: invalid_email_addresses(addresses)), ))
+
+if __name__ == "__main__":
+    if sys.argv[1:] == [ "benchmark", ]:
+        benchmark()
+    else:
+        unittest.main()
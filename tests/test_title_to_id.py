@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+Tests for t4.title_to_id: asciify() and title_to_id() against the
+character by character implementation their translation tables replaced,
+and safe_filenames()’ collision handling.
+
+Run python -m tests.test_title_to_id benchmark from the top directory to
+print the timings of both instead.
+"""
+
+import sys, os.path as op, random, time, unicodedata, unittest
+
+from t4.title_to_id import ( asciify, title_to_id, greek_letters,
+                             safe_filename, safe_filenames, )
+
+def reference_asciify(string):
+    """
+    asciify() as it was before the translation table.
+    """
+    string = unicodedata.normalize("NFC", string)
+
+    temp = ""
+    for char in string:
+        decomp = unicodedata.decomposition(char)
+        if decomp:
+            d = decomp.split()[0]
+            try:
+                temp += chr(int(d, 16))
+            except ValueError:
+                if d == "<super>":
+                    temp += chr(int(decomp.split()[1], 16))
+        else:
+            temp += char
+
+    return temp
+
+def reference_title_to_id(title, all_lowercase=True, separator="_"):
+    """
+    title_to_id() as it was before the translation table, without
+    reserved ids. (It compared them to bytes, so they never matched.)
+    """
+    title = str(title)
+
+    if all_lowercase: title = title.lower()
+    title = title.replace("ß", "ss")
+    title = reference_asciify(title)
+
+    title = title.replace("¹", "1")
+    title = title.replace("²", "2")
+
+    parts = [""]
+    for char in title:
+        if char in "abcdefghijklmnopqrstuvwxyz0123456789":
+            parts[-1] += char
+        elif char in greek_letters:
+            parts[-1] += greek_letters[char]
+        else:
+            if len(parts[-1]) > 0:
+                parts.append("")
+
+    if parts[-1] == "":
+        parts = parts[:-1]
+
+    id = separator.join(parts)
+    id = id.encode("ascii", "ignore")
+
+    if all_lowercase:
+        id = id.lower()
+
+    return id.decode("ascii")
+
+# Latin, Latin-1 and Latin Extended-A, combining marks, Greek, Cyrillic,
+# superscripts, ligatures, fullwidth forms and a few CJK characters.
+alphabet = ( "aZ09 -_.ß¹²³ﬁﬂ"
+             + "".join(map(chr, range(0xc0, 0x180)))
+             + "".join(map(chr, range(0x300, 0x310)))
+             + "".join(map(chr, range(0x386, 0x3d0)))
+             + "".join(map(chr, range(0x400, 0x460)))
+             + "".join(map(chr, range(0x2070, 0x2090)))
+             + "".join(map(chr, range(0xff10, 0xff5b)))
+             + "日本語中文" )
+
+def mixed_script(rng, length):
+    return "".join(rng.choice(alphabet) for a in range(length))
+
+class title_to_id_test(unittest.TestCase):
+    def test_random_strings(self):
+        rng = random.Random(1)
+        for a in range(20000):
+            s = mixed_script(rng, rng.randint(0, 20))
+            self.assertEqual(asciify(s), reference_asciify(s), repr(s))
+            self.assertEqual(title_to_id(s, reserved_ids=()),
+                             reference_title_to_id(s), repr(s))
+            self.assertEqual(
+                title_to_id(s, False, (), "-"),
+                reference_title_to_id(s, False, "-"), repr(s))
+
+    def test_long_string(self):
+        s = mixed_script(random.Random(2), 10000)
+        self.assertEqual(asciify(s), reference_asciify(s))
+        self.assertEqual(title_to_id(s, reserved_ids=()),
+                         reference_title_to_id(s))
+
+    def test_reserved_ids(self):
+        self.assertEqual(title_to_id("Edit"), "Edit")
+        self.assertEqual(title_to_id("Edit", reserved_ids=()), "edit")
+
+def archive_entries(rng, count, distinct=5000, directories=100):
+    """
+    `count` paths like those in an uploaded archive, with `distinct`
+    different file names spread over `directories` directories.
+    """
+    names = [ "%s %i%s" % ( rng.choice([ "Bericht", "Foto", "Rechnung",
+                                          "Übersicht", ".hidden", ]),
+                            a, rng.choice([ ".pdf", ".jpg", ".tar.gz",
+                                            "", ]), )
+              for a in range(distinct) ]
+    return [ "dir%i/%s" % ( rng.randrange(directories), rng.choice(names), )
+             for a in range(count) ]
+
+class safe_filenames_test(unittest.TestCase):
+    def test_collisions(self):
+        self.assertEqual(
+            list(safe_filenames([ "a.pdf", "a.pdf", "b/a.pdf", "a_2.pdf",
+                                  "...", "", ],
+                                existing=[ "a_3.pdf", ],
+                                contains_dir=True)),
+            [ "a.pdf", "a_2.pdf", "a_4.pdf", "a_2_2.pdf", "unnamed",
+              "unnamed_2", ])
+
+    def test_case_insensitive(self):
+        self.assertEqual(
+            list(safe_filenames([ "A.txt", "a.TXT", ], existing=[ "a.txt", ],
+                                case_sensitive=False)),
+            [ "A_2.txt", "a_3.TXT", ])
+
+    def test_archive(self):
+        entries = archive_entries(random.Random(4), 20000)
+        result = list(safe_filenames(entries, contains_dir=True))
+        self.assertEqual(len(set(result)), len(entries))
+
+        for entry, fn in zip(entries, result):
+            safe = safe_filename(entry, contains_dir=True)
+            stem, ext = op.splitext(safe)
+            self.assertTrue(fn == safe or fn.startswith(stem + "_")
+                            and fn.endswith(ext), ( entry, fn, ))
+
+def best_of(function, repeat=5):
+    """
+    The fastest of `repeat` calls to function() in milliseconds.
+    """
+    best = None
+    for a in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+def benchmark():
+    rng = random.Random(3)
+    long_title = mixed_script(rng, 10000)
+    short_title = "Über die „Größe“ der Ελλάδα, Teil ²"
+    titles = [ mixed_script(rng, rng.randint(10, 60)) for a in range(10000) ]
+
+    print("%-30s %12s %12s" % ( "input", "before ms", "after ms", ))
+    for name, function, reference in (
+            ( "asciify, 10k characters",
+              lambda: asciify(long_title),
+              lambda: reference_asciify(long_title), ),
+            ( "title_to_id, 10k characters",
+              lambda: title_to_id(long_title),
+              lambda: reference_title_to_id(long_title), ),
+            ( "title_to_id, short title",
+              lambda: title_to_id(short_title),
+              lambda: reference_title_to_id(short_title), ),
+            ( "title_to_id, 10k titles",
+              lambda: [ title_to_id(title) for title in titles ],
+              lambda: [ reference_title_to_id(title) for title in titles ], ),
+            ):
+        print("%-30s %12.3f %12.3f" % ( name, best_of(reference),
+                                         best_of(function), ))
+
+    # An archive with 100k entries and 5,000 different file names in 100
+    # directories, unpacked into one directory that holds 1,000 files.
+    entries = archive_entries(rng, 100000)
+    existing = [ "Bericht %i.pdf" % a for a in range(1000) ]
+    print()
+    print("%-50s %8s" % ( "100k archive entries", "ms", ))
+    print("%-50s %8.1f" % (
+        "safe_filename() loop, without collision handling",
+        best_of(lambda: [ safe_filename(entry, True) for entry in entries ],
+                3), ))
+    print("%-50s %8.1f" % (
+        "safe_filenames()",
+        best_of(lambda: list(safe_filenames(entries, existing, True)), 3), ))
+    print("%-50s %8.1f" % (
+        "safe_filenames(case_sensitive=False)",
+        best_of(lambda: list(safe_filenames(entries, existing, True,
+                                            case_sensitive=False)), 3), ))
+
+if __name__ == "__main__":
+    if sys.argv[1:] == [ "benchmark", ]:
+        benchmark()
+    else:
+        unittest.main()
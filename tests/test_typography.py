@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+
+##  This file is part of the t4 Python module collection.
+##
+##  Copyright 2003–25 by Diedrich Vorberg <diedrich@tux4web.de>
+##
+##  All Rights Reserved
+##
+##  For more Information on orm see the README file.
+##
+##  This program is free software; you can redistribute it and/or modify
+##  it under the terms of the GNU General Public License as published by
+##  the Free Software Foundation; either version 2 of the License, or
+##  (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##  GNU General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program; if not, write to the Free Software
+##  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+##
+##  I have added a copy of the GPL in the file COPYING
+
+"""
+Differential tests for t4.typography.improve_typography(): The compiled
+single-pass typography_engine must return exactly what the sequential
+re.sub() and str.replace() calls it replaced did, on random strings
+made of the characters the rules react to and on a prose corpus.
+"""
+
+import re, random, unittest
+
+from t4 import typography
+from t4.typography import ( opening_quote_re, closing_quote_re,
+                            opening_single_quote_re, closing_single_quote_re,
+                            date_until_re, )
+
+def reference_improve_typography(content, quotes):
+    """
+    improve_typography() as it was before the typography_engine, with
+    the quotes for a language passed in rather than picked by an
+    if/elif chain.
+    """
+    if quotes is not None:
+        double_open, double_close, single_open, single_close = quotes
+        content = re.sub(opening_quote_re, "\\1%s\\2" % double_open, content)
+        content = re.sub(closing_quote_re, "\\1%s\\2" % double_close, content)
+        content = re.sub(opening_single_quote_re, "\\1%s\\2" % single_open,
+                         content)
+        content = re.sub(closing_single_quote_re, "\\1%s\\2" % single_close,
+                         content)
+
+    content = re.sub(date_until_re, r"\1.–\2.", content)
+    content = content.replace(" - ", " — ")
+    content = content.replace(" ...", "\u00a0…")
+    content = content.replace("...", "…")
+
+    return content
+
+# The characters the rules look at, with the ones they look at most
+# repeated so they come up more often.
+alphabet = ( "aZ09" + '""' + "''" + "..." + "--" + "  " + "\n\t"
+             + ",;!x1" )
+
+words = ( "Der", "Hund", "sagte", '"Hallo"', "'Welt'", "vom", "1.-3.",
+          "Mai", "-", "...", "Ende.", '"Ja',  'nein"', "it's", "'tis",
+          "12.-14.", "und", "so", "weiter", "...und", '("x")', "'a'.", )
+
+class typography_engine_test(unittest.TestCase):
+    languages = ( "de", "en", "fr", "xx", )
+
+    def assertSame(self, content):
+        for lang in self.languages:
+            expected = reference_improve_typography(
+                content, typography.typography_quotes.get(lang))
+            self.assertEqual(typography.improve_typography(content, lang),
+                             expected, "lang=%s content=%r" % ( lang,
+                                                                content, ))
+
+    def test_random_strings(self):
+        rng = random.Random(3)
+        for a in range(20000):
+            self.assertSame("".join(rng.choice(alphabet)
+                                    for b in range(rng.randint(0, 24))))
+
+    def test_prose(self):
+        rng = random.Random(4)
+        for a in range(500):
+            self.assertSame(" ".join(rng.choice(words)
+                                     for b in range(rng.randint(1, 60))))
+
+    def test_long_document(self):
+        rng = random.Random(5)
+        paragraphs = [ " ".join(rng.choice(words) for b in range(80))
+                       for a in range(200) ]
+        self.assertSame("\n\n".join(paragraphs))
+
+    def test_registered_language(self):
+        typography.register_typography_language("xx", ( "»", "«", ),
+                                                ( "›", "‹", ))
+        try:
+            self.assertSame('Er sagte: "Hallo \'du\'" - ...')
+        finally:
+            del typography.typography_quotes["xx"]
+            typography._typography_engines.pop("xx", None)
+
+if __name__ == "__main__":
+    unittest.main()